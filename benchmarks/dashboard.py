@@ -0,0 +1,321 @@
+"""
+Benchmark the render and ingest paths of the dashboard on synthetic histories.
+
+Every sensor gets a history of one reading per minute, ending now, written to
+a LocalStorage in a temporary directory, so no MongoDB is needed. For every
+history size and date range the benchmark reports the latency, the peak
+Python memory and the serialized size of:
+
+    query      Sensor.query_range
+    figure     downsampling and Sensor._create_figure
+    get_card   the whole card of the sensor
+    update_cards  all cards, as rendered by the callback of the page
+
+The ingest benchmark posts readings to /data and polls mocked Tuya and Shelly
+APIs.
+
+    python benchmarks/dashboard.py
+    python benchmarks/dashboard.py --sizes 1000 100000 --ranges day all --json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+RANGES = {"day": 1, "week": 7, "month": 30, "year": 365, "all": None}
+# readings are generated and appended in chunks to bound the memory
+CHUNK_SIZE = 1_000_000
+READING_INTERVAL = np.timedelta64(60, "s")
+
+
+def _daily_wave(minutes: np.ndarray, low: float, high: float) -> np.ndarray:
+    return low + (high - low) * (1 + np.sin(2 * np.pi * minutes / 1440)) / 2
+
+
+def synthetic_columns(minutes: np.ndarray, rng) -> dict[str, np.ndarray]:
+    # Every column a sensor may store, keyed like the sensors' rollup_fields
+    noise = rng.normal(0, 0.3, len(minutes))
+    phases = {
+        # base load with occasional spikes, e.g. the heating or the oven
+        phase: rng.gamma(2.0, 40.0, len(minutes))
+        + (rng.random(len(minutes)) < 0.01) * rng.uniform(1000, 3000, len(minutes))
+        for phase in ["A", "B", "C"]
+    }
+    return {
+        "temperature": np.round(_daily_wave(minutes, 2, 12) + noise, 1),
+        "humidity": np.round(_daily_wave(minutes, 65, 45) + noise, 1),
+        "current_temperature": np.round(_daily_wave(minutes, 4, 9) + noise, 1),
+        "set_temperature": np.full(len(minutes), 5.0),
+        "correction_value": np.zeros(len(minutes)),
+        **phases,
+        "total_power": phases["A"] + phases["B"] + phases["C"],
+    }
+
+
+def fill_history(storage, sensors, size: int, end: np.datetime64) -> None:
+    rng = np.random.default_rng(size)
+    start = end - size * READING_INTERVAL
+    for sensor in sensors:
+        for chunk_start in range(0, size, CHUNK_SIZE):
+            minutes = np.arange(chunk_start, min(size, chunk_start + CHUNK_SIZE))
+            columns = synthetic_columns(minutes, rng)
+            storage.extend(
+                sensor,
+                start + minutes * READING_INTERVAL,
+                {column: columns[column] for column in sensor.rollup_fields},
+            )
+
+
+def measure(function, repeat: int) -> dict:
+    # Timed without tracemalloc, it slows down the Python code it traces
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "result": result,
+        "median_ms": statistics.median(latencies) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "peak_mb": peak / 1024**2,
+    }
+
+
+def benchmark_render(app_module, sizes, ranges, repeat: int, root: Path) -> list:
+    from utils.card_cache import serialized_size
+    from utils.local_storage import LocalStorage
+
+    sensors = app_module.get_sensors().devices
+    now = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+    results = []
+    for size in sizes:
+        storage = LocalStorage(root / str(size))
+        started = time.perf_counter()
+        fill_history(storage, sensors, size, np.datetime64(now, "ms"))
+        print(
+            f"Generated {size} readings per sensor in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+
+        with mock.patch.object(app_module, "get_storage", return_value=storage):
+            for range_name in ranges:
+                days = RANGES[range_name]
+                end_date = now + timedelta(minutes=1)
+                start_date = (
+                    end_date - timedelta(days=days)
+                    if days is not None
+                    else now - timedelta(minutes=size)
+                )
+
+                for sensor in sensors:
+                    query = measure(
+                        lambda: sensor.query_range(
+                            start_date, end_date, sensor.trace_columns
+                        ),
+                        repeat,
+                    )
+                    series = query["result"]
+                    figure = measure(
+                        lambda: sensor._create_figure(
+                            *sensor.downsample(
+                                series.dates,
+                                *(series.columns[c] for c in sensor.trace_columns),
+                            )
+                        ),
+                        repeat,
+                    )
+                    card = measure(lambda: sensor.get_card(start_date, end_date), repeat)
+                    for step, measurement in [
+                        ("query", query),
+                        ("figure", figure),
+                        ("get_card", card),
+                    ]:
+                        result = measurement.pop("result")
+                        size_kb = (
+                            serialized_size(result) / 1024 if step != "query" else None
+                        )
+                        results.append(
+                            {
+                                "sensor": sensor.name,
+                                "points": size,
+                                "range": range_name,
+                                "step": step,
+                                **measurement,
+                                "size_kb": size_kb,
+                            }
+                        )
+
+                cards = measure(
+                    lambda: app_module.update_cards(
+                        start_date.isoformat(), end_date.isoformat()
+                    ),
+                    repeat,
+                )
+                results.append(
+                    {
+                        "sensor": "all",
+                        "points": size,
+                        "range": range_name,
+                        "step": "update_cards",
+                        "median_ms": cards["median_ms"],
+                        "max_ms": cards["max_ms"],
+                        "peak_mb": cards["peak_mb"],
+                        "size_kb": serialized_size(cards["result"]) / 1024,
+                    }
+                )
+        # the larger histories take gigabytes, keep one at a time
+        shutil.rmtree(root / str(size))
+    return results
+
+
+class FakeShellyClient:
+    latencies = {}
+
+    def device_statuses(self, device_ids: list[str]) -> dict[str, dict]:
+        statuses = {}
+        for device_id in device_ids:
+            emeters = [
+                {"power": power, "voltage": 230.0, "is_valid": True}
+                for power in np.random.uniform(50, 500, 3)
+            ]
+            statuses[device_id] = {
+                "emeters": emeters,
+                "total_power": sum(emeter["power"] for emeter in emeters),
+            }
+        return statuses
+
+
+class FakeTuyaClient:
+    # status data points read by BottomBathroomTempSensor and KellerPlug
+    status = [{"value": value} for value in [215, 45, "high", 5, 0, 0, 8, 0]]
+
+    def device_statuses(self, device_ids: list[str]) -> dict[str, list[dict]]:
+        return {device_id: self.status for device_id in device_ids}
+
+
+def benchmark_ingest(app_module, readings: int, root: Path) -> list:
+    from utils.local_storage import LocalStorage
+
+    storage = LocalStorage(root / "ingest")
+    flask_app = app_module.create_app()
+    client = flask_app.server.test_client()
+    steps = {
+        "handle_data": lambda: client.post(
+            "/data", data={"temperature": "21.5", "humidity": "40.2"}
+        ),
+        "log_tuya_values": app_module.log_tuya_values,
+        "log_shelly_values": app_module.log_shelly_values,
+    }
+
+    results = []
+    with mock.patch.object(
+        app_module, "get_storage", return_value=storage
+    ), mock.patch.object(
+        app_module, "get_tuya_client", return_value=FakeTuyaClient()
+    ), mock.patch.object(
+        app_module, "get_shelly_client", return_value=FakeShellyClient()
+    ):
+        for step, function in steps.items():
+            measurement = measure(function, readings)
+            measurement.pop("result")
+            results.append(
+                {
+                    "sensor": "ingest",
+                    "points": readings,
+                    "range": None,
+                    "step": step,
+                    **measurement,
+                    "size_kb": None,
+                }
+            )
+    return results
+
+
+def write_config(root: Path) -> Path:
+    config_path = root / "buerchen_config.json"
+    config = {
+        "sender_address": "benchmark@localhost",
+        "receiver_addresses": [],
+        "tuya_access_id": "benchmark",
+        "tuya_access_key": "benchmark",
+        "shelly_auth_key": "benchmark",
+        "storage_backend": "local",
+        "local_storage_path": str(root / "data"),
+        "polling_enabled": False,
+        # every request renders the cards again
+        "card_cache_ttl": 0,
+    }
+    config_path.write_text(json.dumps(config))
+    return config_path
+
+
+def print_table(results: list) -> None:
+    header = (
+        f"{'sensor':<24}{'points':>10}  {'range':<7}{'step':<19}"
+        f"{'median ms':>10}{'max ms':>10}{'peak MB':>9}{'size KB':>9}"
+    )
+    print(header)
+    for result in results:
+        size_kb = f"{result['size_kb']:.0f}" if result["size_kb"] is not None else "-"
+        print(
+            f"{result['sensor']:<24}{result['points']:>10}  {result['range'] or '-':<7}"
+            f"{result['step']:<19}{result['median_ms']:>10.1f}{result['max_ms']:>10.1f}"
+            f"{result['peak_mb']:>9.1f}{size_kb:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument(
+        "--ranges", nargs="+", choices=list(RANGES), default=list(RANGES)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--ingest-readings",
+        type=int,
+        default=200,
+        help="Readings logged by every ingest step, 0 skips the ingest benchmark.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the raw results.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="buerchen-benchmark-") as directory:
+        root = Path(directory)
+        # temperature_app reads the config path on import
+        os.environ["BUERCHEN_CONFIG"] = str(write_config(root))
+        import temperature_app
+
+        results = benchmark_render(
+            temperature_app, sorted(args.sizes), args.ranges, args.repeat, root
+        )
+        if args.ingest_readings:
+            results += benchmark_ingest(temperature_app, args.ingest_readings, root)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
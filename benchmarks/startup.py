@@ -0,0 +1,120 @@
+"""
+Measure the cold start of the dashboard, as seen after a worker restart.
+
+Every run starts a fresh interpreter that imports temperature_app, builds the
+app with create_app() and serves its first requests through the Flask test
+client. The first card request reads the database of the config, leave it out
+with --no-cards when no MongoDB is reachable.
+
+    python benchmarks/startup.py --runs 5
+    BUERCHEN_CONFIG=~/.config/buerchen_config.json python benchmarks/startup.py
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# modules that should only be imported by create_app or on first use
+HEAVY_MODULES = ["dash", "plotly", "flask", "requests", "tuya_connector", "pyarrow"]
+
+CHILD = """
+import json, sys, time
+
+timings = {}
+started = time.perf_counter()
+import temperature_app
+timings["import"] = time.perf_counter() - started
+heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+
+started = time.perf_counter()
+app = temperature_app.create_app()
+timings["create_app"] = time.perf_counter() - started
+
+client = app.server.test_client()
+for name, path in [("first_page", "/"), ("first_layout", "/_dash-layout")]:
+    started = time.perf_counter()
+    response = client.get(path)
+    timings[name] = time.perf_counter() - started
+    assert response.status_code == 200, (path, response.status_code)
+
+if CARDS_PAYLOAD is not None:
+    started = time.perf_counter()
+    response = client.post("/_dash-update-component", json=CARDS_PAYLOAD)
+    timings["first_cards"] = time.perf_counter() - started
+    assert response.status_code == 200, response.status_code
+
+print(json.dumps({"timings": timings, "heavy_modules": heavy_modules}))
+"""
+
+
+def cards_payload() -> dict:
+    # The update_cards request sent by the browser on page load
+    today = datetime.now().date()
+    dates = [
+        (today - timedelta(days=1)).isoformat(),
+        (today + timedelta(days=1)).isoformat(),
+    ]
+    return {
+        "output": "sensor-cards.children",
+        "outputs": {"id": "sensor-cards", "property": "children"},
+        "inputs": [
+            {"id": "start-date-picker", "property": "date", "value": dates[0]},
+            {"id": "end-date-picker", "property": "date", "value": dates[1]},
+        ],
+        "changedPropIds": ["start-date-picker.date"],
+        "state": [],
+    }
+
+
+def run_once(with_cards: bool) -> dict:
+    code = (
+        f"HEAVY_MODULES = {HEAVY_MODULES!r}\n"
+        f"CARDS_PAYLOAD = {cards_payload() if with_cards else None!r}\n" + CHILD
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # the app may print to stdout, the measurements are on the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--no-cards",
+        dest="cards",
+        action="store_false",
+        help="Skip the first card request, it needs a reachable MongoDB.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the raw results.")
+    args = parser.parse_args()
+
+    results = [run_once(args.cards) for _ in range(args.runs)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'step':<14}{'median ms':>12}{'max ms':>12}")
+    for step in results[0]["timings"]:
+        values = [result["timings"][step] * 1000 for result in results]
+        print(f"{step:<14}{statistics.median(values):>12.1f}{max(values):>12.1f}")
+
+    heavy_modules = sorted(
+        {name for result in results for name in result["heavy_modules"]}
+    )
+    if heavy_modules:
+        print(f"Imported by temperature_app itself: {', '.join(heavy_modules)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Resident collector replacing the db_connector.py cronjob.
+
+The config, the mongo connection pool and the sensor clients are set up once,
+then every source is read on its own schedule (seconds, from the config):
+
+    "home_assistant_interval": 300,
+    "inkbird_interval": 300
+
+With "inkbird_gatt_polling": true, the inkbird sensors are read over GATT
+connections by an InkbirdPoller ("inkbird_max_connections", 1 by default)
+instead of from their advertisements.
+
+With "metrics_port" in the config, the timings of the BLE and mongo calls are
+served in the Prometheus text format on that port.
+
+Stop it with SIGINT or SIGTERM, pending writes are flushed before exiting.
+"""
+import logging
+import signal
+from threading import Event
+
+from pymongo import MongoClient
+
+from db_connector import (
+    INKBIRD_MAC_ADDRESS,
+    get_home_assistant_sensor,
+    load_config,
+    log_home_assistant,
+    log_inkbird,
+    log_inkbird_poller,
+)
+from inkbirdsensor import InkbirdPoller, InkbirdScanner
+from utils import metrics
+from utils.scheduler import PollScheduler
+from utils.write_buffer import WriteBuffer
+
+
+def report_run(job):
+    status = "failed" if job.consecutive_failures else "ok"
+    logging.info(
+        "{} cycle {} {} in {:0.2f}s (mean {:0.2f}s, {} failures)".format(
+            job.name, job.runs, status, job.last_latency,
+            job.total_latency / job.runs, job.failures))
+
+
+def main():
+    config = load_config()
+
+    # connections are kept open between cycles
+    client = MongoClient(config['mongo_uri'], event_listeners=[metrics.MongoCommandMetrics()])
+    db = client.ppb
+    write_buffer = WriteBuffer()
+    home_assistant_sensor = get_home_assistant_sensor(config)
+    inkbird_mac_addresses = config.get('inkbird_mac_addresses', [INKBIRD_MAC_ADDRESS])
+    inkbird_interval = config.get('inkbird_interval', 300)
+
+    scheduler = PollScheduler(on_run=report_run)
+    scheduler.add_job(
+        'home assistant',
+        config.get('home_assistant_interval', 300),
+        lambda: log_home_assistant(home_assistant_sensor, db, write_buffer),
+    )
+    inkbird_poller = None
+    if config.get('inkbird_gatt_polling', False):
+        # sensors out of advertising range are read over bounded connections
+        inkbird_poller = InkbirdPoller(
+            inkbird_mac_addresses,
+            measure_interval=inkbird_interval,
+            max_connections=config.get('inkbird_max_connections', 1),
+        )
+        logged = {}
+        scheduler.add_job(
+            'inkbird',
+            inkbird_interval,
+            lambda: log_inkbird_poller(inkbird_poller, db, write_buffer, logged),
+        )
+    else:
+        inkbird_scanner = InkbirdScanner(inkbird_mac_addresses)
+        scheduler.add_job(
+            'inkbird',
+            inkbird_interval,
+            lambda: log_inkbird(inkbird_scanner, db, write_buffer),
+        )
+
+    stopped = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+
+    if config.get('metrics_port'):
+        metrics.serve(config['metrics_port'])
+
+    if inkbird_poller is not None:
+        inkbird_poller.start()
+    scheduler.start()
+    logging.info("collector started")
+    stopped.wait()
+
+    logging.info("stopping collector")
+    scheduler.stop()
+    if inkbird_poller is not None:
+        inkbird_poller.stop()
+    write_buffer.close()
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
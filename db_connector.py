@@ -1,6 +1,7 @@
 """
 Read the temperature and humidity from sensors and upload them to the mongodb.
-This script is executed every 5 minutes as a cronjob.
+This script is executed every 5 minutes as a cronjob, collector.py runs the same
+readings as a resident daemon.
 """
 import json
 import time
@@ -8,47 +9,88 @@ from pathlib import Path
 from pymongo import MongoClient
 
 from home_assistant_sensor import HomeAssistantSensor
-from inkbirdsensor import InkbirdSensor
+from inkbirdsensor import InkbirdScanner
+from utils.write_buffer import WriteBuffer
 
 config_path = Path('/home/hendrik/.config/burchen_db.json')
 
-with open(config_path, 'rt') as json_file:
-    config = json.load(json_file)
-
-# setup database connection
-client = MongoClient(config['mongo_uri'])
-db = client.ppb
-inkbird1_collection = db.inkbird1
-HA_sensor1_collection = db.HA_sensor1
-
-# setup home assistant sensor
-home_assistant_sensor = HomeAssistantSensor(config['home_assistant_api_url'],
-                                            config['home_assistant_temperature_entity_id'],
-                                            config['home_assistant_humidity_entity_id'],
-                                            config['home_assistant_api_token'])
-home_assistant_temperature, home_assistant_humidity = home_assistant_sensor.read_sensor()
-
-# insert HA values to db
-HA_sensor1_collection.insert_one(
-    {
-        'temp': home_assistant_temperature,
-        'humidity': home_assistant_humidity,
-        'date': time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime())
-    }
-
-)
-
-# setup inkbird sensor
 INKBIRD_MAC_ADDRESS = '78:DB:2F:CE:29:4C'
-inkbird_sensor = InkbirdSensor(INKBIRD_MAC_ADDRESS)
-inkbird_temperature, inkbird_humidity = inkbird_sensor.get_measurements()
 
-if inkbird_temperature:
-    inkbird1_collection.insert_one(
+
+def load_config():
+    with open(config_path, 'rt') as json_file:
+        return json.load(json_file)
+
+
+def get_home_assistant_sensor(config):
+    return HomeAssistantSensor(config['home_assistant_api_url'],
+                               config['home_assistant_temperature_entity_id'],
+                               config['home_assistant_humidity_entity_id'],
+                               config['home_assistant_api_token'])
+
+
+def log_home_assistant(home_assistant_sensor, db, write_buffer):
+    home_assistant_temperature, home_assistant_humidity = home_assistant_sensor.read_sensor()
+
+    # insert HA values to db
+    write_buffer.insert(
+        db.HA_sensor1,
         {
-            'temp': inkbird_temperature,
-            'humidity': inkbird_humidity,
+            'temp': home_assistant_temperature,
+            'humidity': home_assistant_humidity,
             'date': time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime())
-        }
-
+        },
     )
+
+
+def log_inkbird(inkbird_scanner, db, write_buffer):
+    # read the sensors from their advertisements
+    for sensor_MAC, (inkbird_temperature, inkbird_humidity) in inkbird_scanner.scan().items():
+        write_buffer.insert(
+            db.inkbird1,
+            {
+                # the readings of every inkbird sensor share the collection
+                'sensor': sensor_MAC,
+                'temp': inkbird_temperature,
+                'humidity': inkbird_humidity,
+                'date': time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime())
+            },
+        )
+
+
+def log_inkbird_poller(inkbird_poller, db, write_buffer, logged):
+    # write the readings the poller got since the previous call,
+    # logged holds the time of the last written reading of every sensor
+    for sensor_MAC, (inkbird_temperature, inkbird_humidity, read_at) in \
+            inkbird_poller.store.snapshot().items():
+        if logged.get(sensor_MAC) == read_at:
+            continue
+        logged[sensor_MAC] = read_at
+        write_buffer.insert(
+            db.inkbird1,
+            {
+                'sensor': sensor_MAC,
+                'temp': inkbird_temperature,
+                'humidity': inkbird_humidity,
+                'date': time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime(read_at))
+            },
+        )
+
+
+def main():
+    config = load_config()
+
+    # setup database connection
+    client = MongoClient(config['mongo_uri'])
+    db = client.ppb
+    write_buffer = WriteBuffer()
+
+    log_home_assistant(get_home_assistant_sensor(config), db, write_buffer)
+    log_inkbird(InkbirdScanner([INKBIRD_MAC_ADDRESS]), db, write_buffer)
+
+    # write the buffered readings before exiting
+    write_buffer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,35 @@
+import random
 import time
-from threading import Thread
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
 import numpy as np
 from bluepy import btle
 import logging
 
+from utils.metrics import EXTERNAL_CALL_SECONDS, INGEST_ERRORS_TOTAL
+
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
-
 class InkbirdSensor():
     # Get values from Inkbird IBS-TH1
 
     def __init__(self, sensor_MAC, measure_interval=5):
         self.sensor_MAC = sensor_MAC
-        self.temperature = np.NaN
-        self.humidity = np.NaN
-        self.last_measure_time_string = np.NaN
-        # self.measure = True
-        # self.measure_interval = measure_interval
+        self.temperature = np.nan
+        self.humidity = np.nan
+        self.last_measure_time_string = np.nan
+        self.measure = False
+        self.measure_interval = measure_interval
 
     # while measure true read sensor
     def measurement_loop(self):
         while self.measure:
             readings = self.read_sensor(self.sensor_MAC)
             if readings:
-                self.temperature, self.humidity = readings
-                self.last_measure_time_string = time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime())
+                self.update_measurements(*readings)
             time.sleep(self.measure_interval)
 
     def stop_measure(self):
@@ -60,21 +62,29 @@ class InkbirdSensor():
             num = -((num ^ 0xffff) + 1)
         return float(num) / 100
 
-    def read_sensor(self, mac_address: str):
+    def update_measurements(self, temperature_c, humidity):
+        self.temperature = temperature_c
+        self.humidity = humidity
+        self.last_measure_time_string = time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime())
+
+    def read_sensor(self, mac_address: str, max_retries: int = 30):
         """Try to connect to sensor every 10 seconds for 5 minutes."""
         nbr_tries = 0
         connection_failed = True
         while connection_failed:
-            if nbr_tries > 30:
+            if nbr_tries > max_retries:
                 return np.nan, np.nan
             try:
-                dev = btle.Peripheral(mac_address, addrType=btle.ADDR_TYPE_PUBLIC)
-                readings = dev.readCharacteristic(0x002d)
+                with EXTERNAL_CALL_SECONDS.time(service='ble', operation='read'):
+                    dev = btle.Peripheral(mac_address, addrType=btle.ADDR_TYPE_PUBLIC)
+                    readings = dev.readCharacteristic(0x002d)
                 connection_failed = False
             except Exception as e:
-                print("Error reading BTLE: {}".format(e))
-                time.sleep(10)
+                logging.warning("Error reading BTLE: {}".format(e))
+                INGEST_ERRORS_TOTAL.inc(device=mac_address)
                 nbr_tries += 1
+                if nbr_tries <= max_retries:
+                    time.sleep(10)
 
         # little endian, first two bytes are temp_c, second two bytes are humidity
         temperature_c = self.convert_to_float_value(readings[0:2])
@@ -84,3 +94,186 @@ class InkbirdSensor():
             "converted data: temperature_c[{:0.2f}], humidity[{:0.2f}]".format(temperature_c, humidity))
 
         return temperature_c, humidity
+
+
+class InkbirdScanner(btle.DefaultDelegate):
+    # Read many Inkbird IBS-TH1 from their advertisements, in a single passive scan
+
+    def __init__(self, sensor_MACs, scan_window=10.0):
+        btle.DefaultDelegate.__init__(self)
+        self.sensors = {mac.lower(): InkbirdSensor(mac) for mac in sensor_MACs}
+        self.scan_window = scan_window
+        self.readings = {}
+
+    def decode_advertisement(self, sensor, manufacturer_data: bytes):
+        # little endian, same layout as the live characteristic:
+        # temp_c, humidity, probe type, crc (2 bytes), battery, ...
+        if len(manufacturer_data) < 9:
+            return None
+        temperature_c = sensor.convert_to_float_value(manufacturer_data[0:2])
+        humidity = sensor.convert_to_float_value(manufacturer_data[2:4])
+        return temperature_c, humidity
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        sensor = self.sensors.get(dev.addr.lower())
+        if sensor is None:
+            return
+        manufacturer_data = dev.getValueText(btle.ScanEntry.MANUFACTURER)
+        if manufacturer_data is None:
+            return
+        readings = self.decode_advertisement(sensor, bytes.fromhex(manufacturer_data))
+        if readings:
+            sensor.update_measurements(*readings)
+            self.readings[sensor.sensor_MAC] = readings
+
+    def scan(self, gatt_fallback=True):
+        """Readings of every registered sensor heard during one scan window."""
+        self.readings = {}
+        scanner = btle.Scanner().withDelegate(self)
+        with EXTERNAL_CALL_SECONDS.time(service='ble', operation='scan'):
+            scanner.scan(self.scan_window, passive=True)
+
+        logging.info(
+            "scan received {} of {} sensors".format(len(self.readings), len(self.sensors)))
+
+        # connect only to the sensors which did not advertise during the scan
+        if gatt_fallback:
+            for sensor in self.sensors.values():
+                if sensor.sensor_MAC in self.readings:
+                    continue
+                readings = sensor.read_sensor(sensor.sensor_MAC, max_retries=0)
+                if not np.isnan(readings[0]):
+                    sensor.update_measurements(*readings)
+                    self.readings[sensor.sensor_MAC] = readings
+
+        return self.readings
+
+
+class ReadingStore():
+    # Latest reading of every sensor, shared between threads
+
+    def __init__(self):
+        self._lock = Lock()
+        self._readings = {}
+
+    def update(self, sensor_MAC, temperature_c, humidity):
+        with self._lock:
+            self._readings[sensor_MAC] = (temperature_c, humidity, time.time())
+
+    def get(self, sensor_MAC):
+        """(temperature_c, humidity, unix time of the reading), None if never read."""
+        with self._lock:
+            return self._readings.get(sensor_MAC)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._readings)
+
+
+class InkbirdPoller():
+    """Poll many Inkbird sensors over a bounded number of BLE connections.
+
+    A single scheduling thread starts the due reads, at most max_connections
+    at once as the BLE adapter only handles a few connections. bluepy has no
+    connect timeout: a read taking longer than read_deadline seconds counts as
+    failed and its thread is left behind without holding a connection slot,
+    so an unreachable sensor does not hold back the others. Failing sensors
+    are retried after a jittered exponential backoff.
+    """
+
+    def __init__(self, sensor_MACs, measure_interval=60, max_connections=1,
+                 read_deadline=30, max_backoff=600):
+        self.sensors = {mac: InkbirdSensor(mac, measure_interval) for mac in sensor_MACs}
+        self.measure_interval = measure_interval
+        self.max_connections = max_connections
+        self.read_deadline = read_deadline
+        self.max_backoff = max_backoff
+        self.store = ReadingStore()
+
+        self._next_read = {mac: 0.0 for mac in sensor_MACs}
+        self._failures = {mac: 0 for mac in sensor_MACs}
+        self._in_flight = {}
+        self._started = {}
+        self._expired = set()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name="inkbird-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def backoff_delay(self, failures):
+        # equal jitter on an exponential backoff capped at max_backoff: the delay
+        # is at least half the backoff, failing sensors are never retried at once
+        delay = min(self.max_backoff, self.measure_interval * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def poll(self):
+        # Collect finished or expired reads, then submit the due ones
+        now = time.monotonic()
+        for mac, future in list(self._in_flight.items()):
+            if future.done():
+                del self._in_flight[mac]
+                self._started.pop(mac, None)
+                try:
+                    readings = future.result()
+                except Exception as e:
+                    logging.warning("reading {} failed: {}".format(mac, e))
+                    readings = None
+                if mac in self._expired:
+                    # the failure was already counted, only keep a late reading
+                    self._expired.discard(mac)
+                    if readings is not None and not np.isnan(readings[0]):
+                        self._record(mac, readings)
+                else:
+                    self._record(mac, readings)
+            elif (mac not in self._expired and mac in self._started
+                  and now - self._started[mac] > self.read_deadline):
+                logging.warning("reading {} missed its deadline".format(mac))
+                self._expired.add(mac)
+                self._record(mac, None)
+
+        # expired reads do not count, their sensor is skipped until they return
+        connections = len(self._in_flight) - len(self._expired)
+        for mac, next_read in self._next_read.items():
+            if connections >= self.max_connections:
+                break
+            if next_read <= now and mac not in self._in_flight:
+                self._started[mac] = now
+                self._in_flight[mac] = self._submit(mac)
+                connections += 1
+
+    def _submit(self, mac):
+        # One thread per read, a hung read must not take a worker of a pool
+        future = Future()
+
+        def read():
+            try:
+                future.set_result(self.sensors[mac].read_sensor(mac, max_retries=0))
+            except Exception as e:
+                future.set_exception(e)
+
+        Thread(target=read, name="inkbird-{}".format(mac), daemon=True).start()
+        return future
+
+    def _record(self, mac, readings):
+        now = time.monotonic()
+        if readings is None or np.isnan(readings[0]):
+            self._failures[mac] += 1
+            self._next_read[mac] = now + self.backoff_delay(self._failures[mac])
+            return
+        self._failures[mac] = 0
+        self._next_read[mac] = now + self.measure_interval
+        self.sensors[mac].update_measurements(*readings)
+        self.store.update(mac, *readings)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(1)
@@ -0,0 +1,112 @@
+"""
+Maintenance commands for the sensor database.
+
+    python manage.py backfill-rollups
+    python manage.py migrate-timeseries
+    python manage.py compact
+"""
+import argparse
+import sys
+
+from temperature_app import get_sensors, get_storage
+from utils.mongo_storage import MongoStorage
+from utils.rollups import RESOLUTIONS
+from utils.timeseries import copy_to_timeseries
+
+
+def get_mongo_storage() -> MongoStorage:
+    storage = get_storage()
+    if not isinstance(storage, MongoStorage):
+        sys.exit("This command needs the mongo storage backend.")
+    return storage
+
+
+def backfill_rollups(args) -> None:
+    storage = get_mongo_storage()
+    for sensor in get_sensors().devices:
+        if not sensor.rollup_fields:
+            continue
+        for resolution in args.resolutions:
+            storage.backfill_rollups(sensor, resolution)
+            print(f"Rebuilt {resolution} rollups of {sensor.name}")
+
+
+def migrate_timeseries(args) -> None:
+    # Offline copy, stop the app and the collectors while it runs
+    storage = get_mongo_storage()
+    mismatches = []
+    for sensor in get_sensors().devices:
+        source = storage.db[sensor.collection_name]
+        target = storage.timeseries_collection(sensor)
+        if args.replace:
+            target.drop()
+            target = storage.timeseries_collection(sensor)
+        elif target.estimated_document_count():
+            print(f"Skipped {sensor.name}: {target.name} is not empty, see --replace")
+            continue
+
+        copied, rejected = copy_to_timeseries(
+            source, target, sensor.collection_name, args.batch_size
+        )
+        expected = source.count_documents({})
+        stored = target.count_documents({})
+        print(
+            f"Copied {copied} of {expected} readings of {sensor.name} "
+            f"to {target.name}, {rejected} rejected"
+        )
+        if stored != expected:
+            mismatches.append(f"{sensor.name}: {stored} of {expected} readings")
+
+    if mismatches:
+        sys.exit("Row counts differ after the migration:\n" + "\n".join(mismatches))
+    print('Done, set "timeseries_collections": true in the config to use them.')
+
+
+def compact(args) -> None:
+    # Without the pauses of the background job, for a first run on a large history
+    storage = get_storage()
+    for sensor in get_sensors().devices:
+        deleted = sum(storage.compact(sensor, args.batch_size))
+        print(f"Deleted {deleted} readings of {sensor.name} past their retention")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill_parser = commands.add_parser(
+        "backfill-rollups", help="Build the rollup collections from the raw history."
+    )
+    backfill_parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        choices=list(RESOLUTIONS),
+        default=list(RESOLUTIONS),
+    )
+    backfill_parser.set_defaults(func=backfill_rollups)
+
+    migrate_parser = commands.add_parser(
+        "migrate-timeseries",
+        help="Copy the raw readings into time-series collections.",
+    )
+    migrate_parser.add_argument("--batch-size", type=int, default=10000)
+    migrate_parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Drop and copy again the time-series collections holding readings.",
+    )
+    migrate_parser.set_defaults(func=migrate_timeseries)
+
+    compact_parser = commands.add_parser(
+        "compact",
+        help="Delete the readings past the retention_days of the config.",
+    )
+    compact_parser.add_argument("--batch-size", type=int, default=10000)
+    compact_parser.set_defaults(func=compact)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
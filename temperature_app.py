@@ -1,21 +1,58 @@
+import atexit
 import json
+import os
+import time
 import uuid
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from threading import Thread
+from typing import ClassVar
 
-import dash
 import numpy as np
-import plotly.graph_objs as go
 import pytz
-import requests
-from dash import Input, Output, dcc, html
-from flask import request
 from pymongo import MongoClient
-from tuya_connector import TuyaOpenAPI
+
+from utils.alert_rules import (
+    Alert,
+    FallingRate,
+    PowerSpike,
+    RuleEngine,
+    StaleSensor,
+    SustainedBelow,
+)
+from utils.card_cache import CardCache
+from utils.compression import register_compression
+from utils.downsampling import minmax_downsample
+from utils.export import FORMATS, csv_chunks, parquet_chunks
+from utils.figures import scatter_trace, typed_dates, typed_values
+from utils.lazy import lazy
+from utils.metrics import (
+    ALERTS_TOTAL,
+    CONTENT_TYPE,
+    INGEST_ERRORS_TOTAL,
+    READINGS_TOTAL,
+    RENDER_SECONDS,
+    MongoCommandMetrics,
+    render,
+)
+from utils.local_storage import LocalStorage
+from utils.mongo_storage import MongoStorage
+from utils.queries import SeriesRange
+from utils.scheduler import PollScheduler
+from utils.storage import Storage
+from utils.NotificationSystem import NotificationSystem
+from utils.write_buffer import WriteBuffer
+
+# Importing this module has no side effects: the config, the database, the
+# sensors and the dash app are set up on first use, and dash, plotly, requests
+# and the tuya connector are imported where they are needed. Use create_app()
+# to build the dashboard.
 
 # config_fn = Path("~/.config/buerchen_config.json").expanduser()
-config_fn = Path("buerchen_config.json").expanduser()
+config_fn = Path(os.environ.get("BUERCHEN_CONFIG", "buerchen_config.json")).expanduser()
 
 local_timezone = pytz.timezone("Europe/Zurich")
 
@@ -25,11 +62,33 @@ class Config:
     # db setttings
     mongodb_URI: str = None
     mongodb_database: str = None
+    # "mongo" or "local", local keeps the readings in files under local_storage_path
+    storage_backend: str = "mongo"
+    local_storage_path: str = "data"
 
     # notification settings
     notification_sender_address: str = None
     notification_receiver_addresses: list[str] = None
+    # without a password the alerts are only printed
+    notification_password: str = None
+    smtp_host: str = "smtp.gmail.com"
+    smtp_port: int = 587
+    # alerts of the next seconds are sent together in one email
+    notification_digest_interval: float = 60.0
+    # a temperature below temp_warn_limit for alert_sustained_minutes alerts,
+    # then again once back above the limit + hysteresis, at the earliest
+    # alert_cooldown seconds later
     temp_warn_limit: int = 5
+    alert_hysteresis: float = 1.0
+    alert_cooldown: float = 3600.0
+    # streaming alert rules, see utils/alert_rules.py (durations in minutes)
+    alert_sustained_minutes: float = 0.0
+    alert_max_drop_per_hour: float = 3.0
+    alert_drop_window_minutes: float = 60.0
+    alert_stale_minutes: float = 30.0
+    alert_power_spike_factor: float = 3.0
+    alert_power_spike_min_watts: float = 2000.0
+    alert_check_interval: float = 60.0
 
     # port
     flask_port: int = 5000
@@ -40,29 +99,228 @@ class Config:
 
     # shelly settings
     shelly_auth_key: str = None
+    shelly_api_url: str = "https://shelly-103-eu.shelly.cloud/device/status"
+    # {"device_id", "name"} of every Shelly device, the house meter by default
+    shelly_devices: list[dict] = None
+    # concurrent requests, started no faster than the rate limit of the cloud
+    shelly_workers: int = 4
+    shelly_requests_per_second: float = 1.0
+
+    # dashboard settings
+    max_points_per_trace: int = 2000
+    # rollups are read when they still give this many points for the range
+    rollup_min_points: int = 500
+    # cards are rendered concurrently, a card missing the timeout is degraded
+    card_workers: int = 4
+    card_timeout: float = 10.0
+    # rendered cards are cached per sensor and date range
+    card_cache_ttl: float = 300.0
+    card_cache_max_bytes: int = 64 * 1024 * 1024
+    # points kept per trace when live updates extend the graphs
+    live_window_points: int = 2000
+    # traces with this many points are drawn with WebGL
+    webgl_min_points: int = 1000
+    # responses from this size on are compressed, when the client accepts it
+    compression_min_bytes: int = 500
+    # readings read from the database per chunk of an export
+    export_batch_size: int = 10000
+
+    # raw readings in time-series collections, see manage.py migrate-timeseries
+    timeseries_collections: bool = False
+    timeseries_granularity: str = "minutes"
+
+    # days the raw readings ("raw") and the rollups ("minute", "hour", "day")
+    # are kept, tiers missing are kept forever
+    retention_days: dict = None
+    # the compaction deletes batches of readings, pausing between them. It
+    # must run in a single process: enable it in one worker only, or run
+    # manage.py compact instead
+    compaction_enabled: bool = False
+    compaction_interval: float = 3600.0
+    compaction_batch_size: int = 1000
+    compaction_pause: float = 1.0
+    compaction_max_batches: int = 500
+
+    # background polling of the cloud APIs (seconds)
+    polling_enabled: bool = True
+    tuya_poll_interval: float = 300.0
+    shelly_poll_interval: float = 300.0
+
+    # write-behind buffer in front of the collections
+    write_batch_size: int = 500
+    write_flush_interval: float = 1.0
+    write_max_pending: int = 10000
 
     def from_config(self):
         with open(config_fn) as f:
             config = json.load(f)
-            self.mongodb_URI = config["mongodb_URI"]
-            self.mongodb_database = config["mongodb_database"]
+            self.mongodb_URI = config.get("mongodb_URI")
+            self.mongodb_database = config.get("mongodb_database")
+            self.storage_backend = config.get("storage_backend", self.storage_backend)
+            self.local_storage_path = config.get(
+                "local_storage_path", self.local_storage_path
+            )
             self.notification_sender_address = config["sender_address"]
             self.notification_receiver_addresses = config["receiver_addresses"]
+            self.notification_password = config.get(
+                "sender_password", self.notification_password
+            )
+            self.smtp_host = config.get("smtp_host", self.smtp_host)
+            self.smtp_port = config.get("smtp_port", self.smtp_port)
+            self.notification_digest_interval = config.get(
+                "notification_digest_interval", self.notification_digest_interval
+            )
+            self.temp_warn_limit = config.get("temp_warn_limit", self.temp_warn_limit)
+            self.alert_hysteresis = config.get("alert_hysteresis", self.alert_hysteresis)
+            self.alert_cooldown = config.get("alert_cooldown", self.alert_cooldown)
+            for key in [
+                "alert_sustained_minutes",
+                "alert_max_drop_per_hour",
+                "alert_drop_window_minutes",
+                "alert_stale_minutes",
+                "alert_power_spike_factor",
+                "alert_power_spike_min_watts",
+                "alert_check_interval",
+            ]:
+                setattr(self, key, config.get(key, getattr(self, key)))
             self.tuya_access_id = config["tuya_access_id"]
             self.tuya_access_key = config["tuya_access_key"]
             self.shelly_auth_key = config["shelly_auth_key"]
+            self.shelly_api_url = config.get("shelly_api_url", self.shelly_api_url)
+            self.shelly_devices = config.get("shelly_devices", self.shelly_devices)
+            self.shelly_workers = config.get("shelly_workers", self.shelly_workers)
+            self.shelly_requests_per_second = config.get(
+                "shelly_requests_per_second", self.shelly_requests_per_second
+            )
+            self.max_points_per_trace = config.get(
+                "max_points_per_trace", self.max_points_per_trace
+            )
+            self.rollup_min_points = config.get(
+                "rollup_min_points", self.rollup_min_points
+            )
+            self.card_workers = config.get("card_workers", self.card_workers)
+            self.card_timeout = config.get("card_timeout", self.card_timeout)
+            self.card_cache_ttl = config.get("card_cache_ttl", self.card_cache_ttl)
+            self.card_cache_max_bytes = config.get(
+                "card_cache_max_bytes", self.card_cache_max_bytes
+            )
+            self.live_window_points = config.get(
+                "live_window_points", self.live_window_points
+            )
+            self.webgl_min_points = config.get(
+                "webgl_min_points", self.webgl_min_points
+            )
+            self.export_batch_size = config.get(
+                "export_batch_size", self.export_batch_size
+            )
+            self.compression_min_bytes = config.get(
+                "compression_min_bytes", self.compression_min_bytes
+            )
+            self.timeseries_collections = config.get(
+                "timeseries_collections", self.timeseries_collections
+            )
+            self.timeseries_granularity = config.get(
+                "timeseries_granularity", self.timeseries_granularity
+            )
+            self.retention_days = config.get("retention_days", self.retention_days)
+            for key in [
+                "compaction_enabled",
+                "compaction_interval",
+                "compaction_batch_size",
+                "compaction_pause",
+                "compaction_max_batches",
+            ]:
+                setattr(self, key, config.get(key, getattr(self, key)))
+            self.polling_enabled = config.get("polling_enabled", self.polling_enabled)
+            self.tuya_poll_interval = config.get(
+                "tuya_poll_interval", self.tuya_poll_interval
+            )
+            self.shelly_poll_interval = config.get(
+                "shelly_poll_interval", self.shelly_poll_interval
+            )
+            self.write_batch_size = config.get(
+                "write_batch_size", self.write_batch_size
+            )
+            self.write_flush_interval = config.get(
+                "write_flush_interval", self.write_flush_interval
+            )
+            self.write_max_pending = config.get(
+                "write_max_pending", self.write_max_pending
+            )
 
         return self
 
 
-CONFIG = Config().from_config()
+@lazy
+def get_config() -> Config:
+    return Config().from_config()
+
+
+@lazy
+def get_db():
+    # MongoClient connects in the background, on the first operation
+    config = get_config()
+    client = MongoClient(config.mongodb_URI, event_listeners=[MongoCommandMetrics()])
+    return client[config.mongodb_database]
+
+
+@lazy
+def get_write_buffer() -> WriteBuffer:
+    # Readings are written in batches, off the ingest path
+    config = get_config()
+    write_buffer = WriteBuffer(
+        batch_size=config.write_batch_size,
+        flush_interval=config.write_flush_interval,
+        max_pending=config.write_max_pending,
+    )
+    atexit.register(write_buffer.close)
+    return write_buffer
+
+
+@lazy
+def get_card_executor() -> ThreadPoolExecutor:
+    # Bounded pool rendering the sensor cards of update_cards concurrently
+    return ThreadPoolExecutor(
+        max_workers=get_config().card_workers, thread_name_prefix="card"
+    )
+
 
-# Initialize Dash app
-app = dash.Dash(__name__, requests_pathname_prefix='/buerchen/')
-app.title = "Ob der Baechi"
+@lazy
+def get_card_cache() -> CardCache:
+    config = get_config()
+    return CardCache(ttl=config.card_cache_ttl, max_bytes=config.card_cache_max_bytes)
 
-mongo_client = MongoClient(CONFIG.mongodb_URI)
-db = mongo_client[CONFIG.mongodb_database]
+
+@lazy
+def get_notification_system() -> NotificationSystem:
+    config = get_config()
+    notification_system = NotificationSystem(
+        config.notification_sender_address,
+        config.notification_receiver_addresses,
+        password=config.notification_password,
+        smtp_host=config.smtp_host,
+        smtp_port=config.smtp_port,
+        digest_interval=config.notification_digest_interval,
+    )
+    atexit.register(notification_system.close)
+    return notification_system
+
+
+@lazy
+def get_storage() -> Storage:
+    config = get_config()
+    if config.storage_backend == "local":
+        return LocalStorage(config.local_storage_path)
+    if config.storage_backend != "mongo":
+        raise ValueError(f"Unknown storage backend {config.storage_backend}")
+    return MongoStorage(
+        get_db(),
+        get_write_buffer(),
+        rollup_min_points=config.rollup_min_points,
+        timeseries=config.timeseries_collections,
+        timeseries_granularity=config.timeseries_granularity,
+        retention=config.retention_days,
+    )
 
 
 def convert_tuya_temp(temp: int) -> float:
@@ -74,87 +332,224 @@ class Sensor:
     name: str = None
     device_id: str = None
     collection_name: str = None
-    mongo_collection: any = None
     uid: str = None
+    # rolled up field -> path of the value in the raw documents
+    rollup_fields: ClassVar[dict[str, str]] = {}
+    # columns plotted by the traces of the card figure, in trace order
+    trace_columns: ClassVar[list[str]] = []
+    # fields of the latest reading kept in the status document
+    status_fields: ClassVar[list[str]] = []
+    # columns of an export -> path of the value, the rollup fields by default.
+    # Only numbers are exported, e.g. not the battery_state of the Tuya sensors
+    export_fields: ClassVar[dict[str, str]] = None
+    # fields watched by the alert rules
+    alert_temperature_field: ClassVar[str] = None
+    alert_power_field: ClassVar[str] = None
+    # the last status read by this process, shown by the degraded card
+    cached_status: dict = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
-        self.mongo_collection = db[self.collection_name]
-        self.uid = str(uuid.uuid4().hex)
+        # the same in every worker process, the callbacks are registered by uid
+        self.uid = uuid.uuid5(uuid.NAMESPACE_URL, self.collection_name).hex
+
+    @property
+    def storage(self) -> Storage:
+        return get_storage()
+
+    def insert_reading(self, document: dict) -> None:
+        READINGS_TOTAL.inc(device=self.name)
+        get_rule_engine().evaluate(self.name, document)
+        # cached cards are dropped once the reading is stored
+        self.storage.append(
+            self, document, callback=lambda: get_card_cache().invalidate(self.uid)
+        )
 
-    def verify_temperature_value(self, temperature_value: float):
-        if temperature_value < CONFIG.temp_warn_limit:
-            # notification_system.notify(
-            print(
-                f"Temperature of {self.name} is below {CONFIG.temp_warn_limit}",
-                f"Temperature is {temperature_value}°C",
-            )
+    def get_status(self) -> dict:
+        # Latest reading of the sensor, whatever the selected range
+        self.cached_status = self.storage.latest(self)
+        return self.cached_status
+
+    def ensure_indexes(self) -> None:
+        self.storage.ensure_indexes(self)
+
+    def query_range(self, start_date, end_date, columns: list[str]) -> SeriesRange:
+        # Read only the given columns, sorted by date
+        return self.storage.query_range(self, start_date, end_date, columns)
+
+    def export(self, start_date, end_date, batch_size: int):
+        fields = self.export_fields or self.rollup_fields
+        return self.storage.export(self, start_date, end_date, fields, batch_size)
+
+    def query_since(self, after: datetime, columns: list[str], limit: int):
+        # Raw readings newer than after, oldest first
+        return self.storage.query_since(self, after, columns, limit)
+
+    def get_live_graph(self, fig, status: dict, start_date) -> list:
+        from dash import dcc
+
+        # The graph is extended by extend_live_graph from the last reading seen
+        last_seen = status["date"] if status is not None else start_date
+        return [
+            dcc.Graph(id=f"{self.uid}-graph", figure=fig),
+            dcc.Store(id=f"{self.uid}-last-seen", data=last_seen.isoformat()),
+        ]
+
+    def extend_live_graph(self, n_intervals, live_mode, end_date, last_seen):
+        from dash.exceptions import PreventUpdate
+
+        # Only ranges reaching the present get new readings
+        if not live_mode or last_seen is None:
+            raise PreventUpdate
+        if end_date and datetime.fromisoformat(end_date) < datetime.now():
+            raise PreventUpdate
+
+        series = self.query_since(
+            datetime.fromisoformat(last_seen),
+            self.trace_columns,
+            get_config().live_window_points,
+        )
+        if not len(series):
+            raise PreventUpdate
+
+        # plain lists, extendTraces does not decode typed arrays
+        dates = typed_dates(series.dates).tolist()
+        extension = {
+            "x": [dates] * len(self.trace_columns),
+            "y": [
+                typed_values(series.columns[column]).tolist()
+                for column in self.trace_columns
+            ],
+        }
+        trace_indices = list(range(len(self.trace_columns)))
+        last_seen = series.dates[-1].astype(datetime).isoformat()
+        return [extension, trace_indices, get_config().live_window_points], last_seen
+
+    def downsample(self, timestamps, *series):
+        # Keep figures at a fixed size, whatever the selected range
+        return minmax_downsample(
+            timestamps, *series, max_points=get_config().max_points_per_trace
+        )
+
+    def get_cached_card(self, start_date, end_date):
+        key = (self.uid, start_date, end_date)
+        card_cache = get_card_cache()
+        card = card_cache.get(key)
+        if card is None:
+            generation = card_cache.generation(self.uid)
+            with RENDER_SECONDS.time(view="get_card", sensor=self.name):
+                card = self.get_card(start_date, end_date)
+            card_cache.put(key, card, generation)
+        return card
+
+    def get_html_sensor_card(self, status: dict, series: SeriesRange = None) -> list:
+        # Headline of the card, the range statistics are left out without series
+        from dash import html
+
+        return [html.H2(self.name)]
+
+    def get_degraded_card(self, message: str):
+        from dash import html
+
+        # No database lookup, the backend may be what is slow: the headline shows
+        # the last status read, or only the name
+        headline = [html.H2(self.name)]
+        if self.cached_status is not None:
+            try:
+                headline = self.get_html_sensor_card(self.cached_status)
+            except Exception as e:
+                print(f"Failed to render the status of {self.name}: {e}")
+        return html.Div(
+            className="card",
+            children=[*headline, html.P(message)],
+        )
 
 
 @dataclass
 class TempHumidSensor(Sensor):
+    rollup_fields: ClassVar[dict[str, str]] = {
+        "temperature": "temperature",
+        "humidity": "humidity",
+    }
+    trace_columns: ClassVar[list[str]] = ["humidity", "temperature"]
+    status_fields: ClassVar[list[str]] = ["temperature", "humidity", "battery_state"]
+    alert_temperature_field: ClassVar[str] = "temperature"
+
     def _create_figure(self, timestamps, humidities, temperatures):
         # Create an interactive plot of the past temperature and humidity values
+        import plotly.graph_objs as go
+
+        Scatter = scatter_trace(len(timestamps), get_config().webgl_min_points)
+        timestamps = typed_dates(timestamps)
         fig = go.Figure()
         fig.add_trace(
-            go.Scatter(x=timestamps, y=humidities, name="Humidity", yaxis="y2")
+            Scatter(
+                x=timestamps, y=typed_values(humidities), name="Humidity", yaxis="y2"
+            )
+        )
+        fig.add_trace(
+            Scatter(x=timestamps, y=typed_values(temperatures), name="Temperature")
         )
-        fig.add_trace(go.Scatter(x=timestamps, y=temperatures, name="Temperature"))
         fig.update_layout(
             xaxis_title="Timestamp",
+            xaxis_type="date",
             yaxis=dict(title="Temperature (Celsius)"),
             yaxis2=dict(title="Humidity (%)", overlaying="y", side="right"),
             hovermode="closest",
         )
         return fig
 
-    def get_html_sensor_card(
-        self, temperatures, humidities, last_entry_date, battery_status=None
-    ):
+    def get_html_sensor_card(self, status: dict, series: SeriesRange = None) -> list:
+        from dash import html
+
+        if status is None:
+            current_temperature = "No data available"
+            current_humidity = "No data available"
+            battery_status = None
+            last_entry_date = "No data available."
+        else:
+            current_temperature = status["temperature"]
+            current_humidity = status["humidity"]
+            battery_status = status.get("battery_state")
+            last_entry_date = status["date"].strftime("%Y-%m-%d %H:%M")
         battery_status_text = (
             f"Battery Status: {battery_status}" if battery_status else ""
         )
-        current_temperature = temperatures[-1] if temperatures else "No data available"
-        current_humidity = humidities[-1] if humidities else "No data available"
-        min_temperature = min(temperatures) if temperatures else "No data available"
-        max_temperature = max(temperatures) if temperatures else "No data available"
-        min_humidity = min(humidities) if humidities else "No data available"
-        max_humidity = max(humidities) if humidities else "No data available"
+        temperature_range = (
+            f" (min: {series.stat('temperature', 'min')}°C, "
+            f"max: {series.stat('temperature', 'max')}°C)"
+            if series is not None
+            else ""
+        )
+        humidity_range = (
+            f" (min: {series.stat('humidity', 'min')}%, "
+            f"max: {series.stat('humidity', 'max')}%)"
+            if series is not None
+            else ""
+        )
 
         return [
             html.H2(self.name),
-            html.P(
-                f"Temperature: {current_temperature}°C "
-                f"(min: {min_temperature}°C, max: {max_temperature}°C)"
-            ),
-            html.P(
-                f"Humidity: {current_humidity}% "
-                f"(min: {min_humidity}%, max: {max_humidity}%)"
-            ),
+            html.P(f"Temperature: {current_temperature}°C{temperature_range}"),
+            html.P(f"Humidity: {current_humidity}%{humidity_range}"),
             html.P(battery_status_text),
             html.P(f"Last entry is from {last_entry_date}"),
         ]
 
     def get_card(self, start_date, end_date):
-        # Fetch data within the given date range
-        past_data = list(
-            self.mongo_collection.find({"date": {"$gte": start_date, "$lte": end_date}})
-        )
+        from dash import html
 
-        if not past_data:
-            past_temperatures = []
-            past_humidities = []
-            timestamps = []
-            last_entry_date = "No data available in the selected range."
-            battery_status = None
-        else:
-            past_temperatures = [data["temperature"] for data in past_data]
-            past_humidities = [data["humidity"] for data in past_data]
-            timestamps = [data["date"] for data in past_data]
-            last_entry_date = timestamps[-1].strftime("%Y-%m-%d %H:%M")
-            battery_status = past_data[-1].get("battery_state")
+        status = self.get_status()
+        # Fetch data within the given date range
+        series = self.query_range(start_date, end_date, ["temperature", "humidity"])
 
         # Create the figure
-        fig = self._create_figure(timestamps, past_humidities, past_temperatures)
+        fig = self._create_figure(
+            *self.downsample(
+                series.dates,
+                series.columns["humidity"],
+                series.columns["temperature"],
+            )
+        )
 
         # Create the card layout using Dash HTML components
         return html.Div(
@@ -163,13 +558,8 @@ class TempHumidSensor(Sensor):
                 html.Div(
                     className="card-body",
                     children=[
-                        *self.get_html_sensor_card(
-                            past_temperatures,
-                            past_humidities,
-                            last_entry_date,
-                            battery_status=battery_status,
-                        ),
-                        dcc.Graph(figure=fig),
+                        *self.get_html_sensor_card(status, series),
+                        *self.get_live_graph(fig, status, start_date),
                     ],
                 )
             ],
@@ -180,18 +570,14 @@ class TempHumidSensor(Sensor):
 class BottomBathroomTempSensor(TempHumidSensor):
     device_id: str = "bfa66db5543bd8c8c4xb4r"
     collection_name: str = "BuerchenBadUntenTempSensor"
-    mongo_collection: any = None
     name: str = "Bad Unten Temperatur"
 
-    def log_status(self, openapi: TuyaOpenAPI) -> None:
-        response = openapi.get(f"/v1.0/iot-03/devices/{self.device_id}/status")
-        temperature = convert_tuya_temp(response["result"][0]["value"])
-        humidity = response["result"][1]["value"]
-        battery_state = response["result"][2]["value"]
-
-        self.verify_temperature_value(temperature)
+    def log_status(self, status: list[dict]) -> None:
+        temperature = convert_tuya_temp(status[0]["value"])
+        humidity = status[1]["value"]
+        battery_state = status[2]["value"]
 
-        result = self.mongo_collection.insert_one(
+        self.insert_reading(
             {
                 "temperature": temperature,
                 "humidity": humidity,
@@ -205,65 +591,93 @@ class BottomBathroomTempSensor(TempHumidSensor):
 class KellerPlug(Sensor):
     device_id: str = "bfd9acf903d28936b8bngr"
     collection_name: str = "KellerPlug"
-    mongo_collection: any = None
     name: str = "Keller Steckdose"
+    rollup_fields: ClassVar[dict[str, str]] = {
+        "current_temperature": "current_temperature",
+        "set_temperature": "set_temperature",
+        "correction_value": "correction_value",
+    }
+    trace_columns: ClassVar[list[str]] = ["current_temperature"]
+    status_fields: ClassVar[list[str]] = [
+        "current_temperature",
+        "set_temperature",
+        "correction_value",
+    ]
+    alert_temperature_field: ClassVar[str] = "current_temperature"
 
-    def log_status(self, openapi: TuyaOpenAPI) -> None:
-        response = openapi.get(f"/v1.0/iot-03/devices/{self.device_id}/status")
-
+    def log_status(self, status: list[dict]) -> None:
         log_dict = {
-            "set_temperature": response["result"][3]["value"],
-            "current_temperature": response["result"][6]["value"],
-            "correction_value": response["result"][7]["value"],
+            "set_temperature": status[3]["value"],
+            "current_temperature": status[6]["value"],
+            "correction_value": status[7]["value"],
             "date": datetime.now(local_timezone),
         }
 
-        self.verify_temperature_value(response["result"][6]["value"])
-
-        self.mongo_collection.insert_one(log_dict)
+        self.insert_reading(log_dict)
 
     def _create_figure(self, timestamps, temperatures):
         # Create an interactive plot of the past temperature values
+        import plotly.graph_objs as go
+
+        Scatter = scatter_trace(len(timestamps), get_config().webgl_min_points)
         fig = go.Figure()
-        fig.add_trace(go.Scatter(x=timestamps, y=temperatures, name="Temperature"))
+        fig.add_trace(
+            Scatter(
+                x=typed_dates(timestamps),
+                y=typed_values(temperatures),
+                name="Temperature",
+            )
+        )
         fig.update_layout(
             xaxis_title="Timestamp",
+            xaxis_type="date",
             yaxis=dict(title="Temperature (Celsius)"),
             hovermode="closest",
         )
         return fig
 
+    def get_html_sensor_card(self, status: dict, series: SeriesRange = None) -> list:
+        from dash import html
+
+        if status is None:
+            return [html.H2(self.name), html.P("No data available")]
+
+        temperature_range = (
+            f" (min: {series.stat('current_temperature', 'min')}°C, "
+            f"max: {series.stat('current_temperature', 'max')}°C)"
+            if series is not None
+            else ""
+        )
+        return [
+            html.H2(self.name),
+            html.P(
+                f"Temperature: {status['current_temperature']}°C{temperature_range}"
+            ),
+            html.P(f"Threshold Temperature: {status['set_temperature']}°C"),
+            html.P(f"Correction Value: {status['correction_value']}°C"),
+            html.P(f"Last entry: {status['date'].strftime('%Y-%m-%d %H:%M')}"),
+        ]
+
     def get_card(self, start_date, end_date):
+        from dash import html
+
+        status = self.get_status()
         # Fetch data within the given date range
-        past_data = list(
-            self.mongo_collection.find({"date": {"$gte": start_date, "$lte": end_date}})
-        )
+        series = self.query_range(start_date, end_date, ["current_temperature"])
 
-        if not past_data:
+        if not len(series):
             return html.Div(
                 className="card",
                 children=[
-                    html.H2(self.name),
-                    html.P("No data available in the last 24 hours"),
+                    *self.get_html_sensor_card(status),
+                    html.P("No data available in the selected range"),
                 ],
             )
 
-        # Extract temperature data
-        past_temperatures = [data["current_temperature"] for data in past_data]
-        timestamps = [data["date"] for data in past_data]
-        threshold_temperature = past_data[-1]["set_temperature"]
-        correction_value = past_data[-1]["correction_value"]
-
-        # Calculate min and max temperatures
-        min_temperature = (
-            min(past_temperatures) if past_temperatures else "No data available"
-        )
-        max_temperature = (
-            max(past_temperatures) if past_temperatures else "No data available"
-        )
-
         # Create the figure
-        fig = self._create_figure(timestamps, past_temperatures)
+        fig = self._create_figure(
+            *self.downsample(series.dates, series.columns["current_temperature"])
+        )
 
         # Return the card layout
         return html.Div(
@@ -272,19 +686,8 @@ class KellerPlug(Sensor):
                 html.Div(
                     className="card-body",
                     children=[
-                        html.H2(self.name),
-                        html.P(
-                            f"Temperature: {past_temperatures[-1]}°C "
-                            f"(min: {min_temperature}°C, max: {max_temperature}°C)"
-                            if past_temperatures
-                            else "No temperature data available"
-                        ),
-                        html.P(f"Threshold Temperature: {threshold_temperature}°C"),
-                        html.P(f"Correction Value: {correction_value}°C"),
-                        html.P(
-                            f"Last entry: {timestamps[-1].strftime('%Y-%m-%d %H:%M')}"
-                        ),
-                        dcc.Graph(figure=fig),
+                        *self.get_html_sensor_card(status, series),
+                        *self.get_live_graph(fig, status, start_date),
                     ],
                 )
             ],
@@ -294,19 +697,13 @@ class KellerPlug(Sensor):
 @dataclass
 class EspTempSensor(TempHumidSensor):
     collection_name: str = "Buerchen Temperatures"
-    mongo_collection: any = None
     name: str = "ESP Temperature Sensor"
 
-    def __post_init__(self):
-        self.mongo_collection = db[self.collection_name]
-
     def log_status(self, post_request) -> None:
         temperature = float(post_request.form["temperature"])
         humidity = float(post_request.form["humidity"])
 
-        self.verify_temperature_value(temperature)
-
-        self.mongo_collection.insert_one(
+        self.insert_reading(
             {
                 "temperature": temperature,
                 "humidity": humidity,
@@ -315,90 +712,96 @@ class EspTempSensor(TempHumidSensor):
         )
 
 
+# values of a phase kept in the Shelly readings, the others are dropped
+SHELLY_PHASES = ["A", "B", "C"]
+SHELLY_EMETER_FIELDS = ["power", "current", "voltage", "pf", "total", "total_returned"]
+
+
 @dataclass
 class ShellyPowerSensor(Sensor):
     collection_name: str = "Shelly Power Sensor"
     name: str = "Shelly Power Sensor"
     device_id: str = "08f9e047bcd5"
-    mongo_collection: any = None
-    api_url: str = "https://shelly-103-eu.shelly.cloud/device/status"
-    auth_key: str = CONFIG.shelly_auth_key
-
-    def log_status(self) -> None:
-        # Fetch data from the Shelly API
-        payload = {
-            "id": self.device_id,
-            "auth_key": self.auth_key,
-        }
-        response = requests.post(self.api_url, data=payload)
-        if response.status_code != 200:
-            print(f"Failed to fetch data for {self.name}")
-            return
-
-        data = response.json()
-        if not data.get("isok"):
-            print(f"Invalid response for {self.name}: {data}")
-            return
-
-        device_status = data["data"]["device_status"]
-        emeter_data = device_status.get("emeters", [{}])[0]
+    rollup_fields: ClassVar[dict[str, str]] = {
+        "A": "emeter_data.A.power",
+        "B": "emeter_data.B.power",
+        "C": "emeter_data.C.power",
+        "total_power": "total_power",
+    }
+    trace_columns: ClassVar[list[str]] = ["A", "B", "C", "total_power"]
+    # every value of the three phases, flattened into columns
+    export_fields: ClassVar[dict[str, str]] = {
+        **{
+            f"{phase}_{name}": f"emeter_data.{phase}.{name}"
+            for phase in SHELLY_PHASES
+            for name in SHELLY_EMETER_FIELDS
+        },
+        "total_power": "total_power",
+    }
+    status_fields: ClassVar[list[str]] = ["total_power"]
+    alert_power_field: ClassVar[str] = "total_power"
+
+    def log_status(self, device_status: dict) -> None:
+        # device_status is fetched by the ShellyClient, see log_shelly_values
         emeter_data = {
-            k: v for k, v in zip(["A", "B", "C"], device_status.get("emeters", []))
+            phase: {
+                field: emeter[field]
+                for field in SHELLY_EMETER_FIELDS
+                if field in emeter
+            }
+            for phase, emeter in zip(SHELLY_PHASES, device_status.get("emeters", []))
         }
 
-        timestamp = datetime.now(local_timezone)
-
-        # Log data to MongoDB
-        self.mongo_collection.insert_one(
+        self.insert_reading(
             {
                 "emeter_data": emeter_data,
-                "date": timestamp,
+                "date": datetime.now(local_timezone),
                 "total_power": device_status.get("total_power"),
             }
         )
 
-    def get_card(self, start_date, end_date):
-        # Fetch data within the given date range
-        past_data = list(
-            self.mongo_collection.find({"date": {"$gte": start_date, "$lte": end_date}})
-        )
+    def get_html_sensor_card(self, status: dict, series: SeriesRange = None) -> list:
+        from dash import html
 
-        if not past_data:
-            return html.Div(
-                className="card",
-                children=[
-                    html.H2(self.name),
-                    html.P("No data available in the selected range"),
-                ],
-            )
+        if status is None:
+            return [html.H2(self.name), html.P("No data available")]
 
-        # Extract data
-        timestamps = [data["date"] for data in past_data]
-        emeter_data = [data["emeter_data"] for data in past_data]
-        total_power = [data.get("total_power", 0) for data in past_data]
+        html_sensor_card = [
+            html.H2(self.name),
+            html.P(f"Total Power: {status['total_power']} W"),
+        ]
+        if series is not None:
+            # Average power over the whole range
+            avg_total_power = series.stats.get("total_power", {}).get("mean")
+            avg_total_power = (
+                round(avg_total_power, 2) if avg_total_power is not None else "No data"
+            )
+            html_sensor_card.append(html.P(f"Average Total Power: {avg_total_power} W"))
+        html_sensor_card.append(
+            html.P(f"Last entry: {status['date'].strftime('%Y-%m-%d %H:%M')}")
+        )
+        return html_sensor_card
 
-        # Aggregate power data for each meter (A, B, C)
-        power_data = {
-            "A": [meter["A"].get("power", 0) for meter in emeter_data],
-            "B": [meter["B"].get("power", 0) for meter in emeter_data],
-            "C": [meter["C"].get("power", 0) for meter in emeter_data],
-        }
+    def _create_figure(self, timestamps, power_a, power_b, power_c, total_power):
+        # Create an interactive plot of the power of each phase and the total
+        import plotly.graph_objs as go
 
-        # Create the Plotly figure
+        Scatter = scatter_trace(len(timestamps), get_config().webgl_min_points)
+        timestamps = typed_dates(timestamps)
         fig = go.Figure()
-        for phase, values in power_data.items():
+        for phase, values in zip(["A", "B", "C"], [power_a, power_b, power_c]):
             fig.add_trace(
-                go.Scatter(
+                Scatter(
                     x=timestamps,
-                    y=values,
+                    y=typed_values(values),
                     mode="lines",
                     name=f"Phase {phase} Power (W)",
                 )
             )
         fig.add_trace(
-            go.Scatter(
+            Scatter(
                 x=timestamps,
-                y=total_power,
+                y=typed_values(total_power),
                 mode="lines",
                 name="Total Power (W)",
                 line=dict(dash="dash"),
@@ -407,13 +810,37 @@ class ShellyPowerSensor(Sensor):
 
         fig.update_layout(
             xaxis_title="Timestamp",
+            xaxis_type="date",
             yaxis=dict(title="Power (W)"),
             hovermode="closest",
             title=f"{self.name} Power Usage",
         )
+        return fig
+
+    def get_card(self, start_date, end_date):
+        from dash import html
 
-        # Calculate average power
-        avg_total_power = round(np.mean(total_power), 2) if total_power else "No data"
+        status = self.get_status()
+        # Fetch data within the given date range
+        series = self.query_range(start_date, end_date, ["A", "B", "C", "total_power"])
+
+        if not len(series):
+            return html.Div(
+                className="card",
+                children=[
+                    *self.get_html_sensor_card(status),
+                    html.P("No data available in the selected range"),
+                ],
+            )
+
+        # Create the figure from the power of each meter (A, B, C) and the total
+        fig = self._create_figure(
+            *self.downsample(
+                series.dates,
+                *(series.columns[phase] for phase in ["A", "B", "C"]),
+                series.columns["total_power"],
+            )
+        )
 
         # Return the card layout
         return html.Div(
@@ -422,136 +849,511 @@ class ShellyPowerSensor(Sensor):
                 html.Div(
                     className="card-body",
                     children=[
-                        html.H2(self.name),
-                        html.P(f"Average Total Power: {avg_total_power} W"),
-                        html.P(
-                            f"Last entry: {timestamps[-1].strftime('%Y-%m-%d %H:%M')}"
-                            if timestamps
-                            else "No data available"
-                        ),
-                        dcc.Graph(figure=fig),
+                        *self.get_html_sensor_card(status, series),
+                        *self.get_live_graph(fig, status, start_date),
                     ],
                 )
             ],
         )
 
 
-TUYA_DEVICES = [BottomBathroomTempSensor(), KellerPlug()]
-ESP_SENSOR = EspTempSensor()
-DEVICES: list[Sensor] = [ESP_SENSOR, *TUYA_DEVICES, ShellyPowerSensor()]
+@dataclass
+class SensorRegistry:
+    esp: EspTempSensor
+    tuya: list[Sensor]
+    shelly: list[ShellyPowerSensor]
+
+    @property
+    def devices(self) -> list[Sensor]:
+        return [self.esp, *self.tuya, *self.shelly]
+
+
+@lazy
+def get_sensors() -> SensorRegistry:
+    shelly_devices = get_config().shelly_devices
+    if shelly_devices is None:
+        shelly = [ShellyPowerSensor()]
+    else:
+        shelly = [
+            ShellyPowerSensor(
+                name=device["name"],
+                device_id=device["device_id"],
+                collection_name=device.get("collection_name", device["name"]),
+            )
+            for device in shelly_devices
+        ]
+    return SensorRegistry(
+        esp=EspTempSensor(),
+        tuya=[BottomBathroomTempSensor(), KellerPlug()],
+        shelly=shelly,
+    )
 
 
-# App layout
-app.layout = html.Div(
-    children=[
-        html.Div(
-            className="card",
-            children=[
-                html.H1("Ob der Baechi", className="card-title"),
-                html.Hr(),
-                html.P(
-                    children=[
-                        "Sauce: ",
-                        html.A(
-                            "GitHub",
-                            href="https://github.com/JulianKlug/TemperatureSensorApp",
-                            target="_blank",  # Open in new tab
-                        ),
-                        html.Div(
-                            [
-                                html.Br(),
-                                html.Br(),
-                                html.Label("Start Date: "),
-                                dcc.DatePickerSingle(
-                                    id="start-date-picker",
-                                    date=(datetime.now() - timedelta(days=1)).date(),
-                                    display_format="YYYY-MM-DD",
-                                    style={"margin-right": "40px"},
-                                ),
-                                html.Label("End Date: "),
-                                dcc.DatePickerSingle(
-                                    id="end-date-picker",
-                                    # Default to tomorrow's date to get all entries from today
-                                    date=datetime.now() + timedelta(days=1),
-                                    display_format="YYYY-MM-DD",
-                                ),
-                            ],
-                        ),
-                    ],
-                    className="card-text",
-                ),
-            ],
-        ),
-        html.Div(
-            id="sensor-cards",
-            children=[
-                html.Div(f"{device.name} data will appear here.", id=f"{device.uid}")
-                for device in DEVICES
-            ],
-        ),
-        dcc.Interval(
-            id="interval-component", interval=10 * 1000, n_intervals=0
-        ),  # Updates every 10 seconds
-        # Add Ceyna at the bottom left
-        html.Div(
-            children=[
-                html.Img(
-                    src="https://github.com/JulianKlug/TemperatureSensorApp/raw/main/ceyna.png",
-                    alt="Ceyna",
-                    style={
-                        "position": "fixed",
-                        "bottom": "10px",
-                        "right": "10px",
-                        "width": "450px",  # Adjust width as needed
-                    },
+def deliver_alert(alert: Alert) -> None:
+    print(alert.title, alert.body)
+    ALERTS_TOTAL.inc(rule=alert.rule, device=alert.sensor)
+    get_notification_system().notify(alert.title, alert.body)
+
+
+def last_reading_time(sensor) -> float:
+    # Epoch seconds of the latest stored reading, None without any
+    try:
+        status = sensor.get_status()
+    except Exception as e:
+        print(f"Failed to read the status of {sensor.name}: {e}")
+        return None
+    if status is None:
+        return None
+    date = status["date"]
+    if date.tzinfo is None:
+        # the storages return naive UTC dates
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+@lazy
+def get_rule_engine() -> RuleEngine:
+    # One instance of every rule per sensor, each holding its own state
+    config = get_config()
+    sensors = get_sensors()
+    # the cloud devices are only logged by processes polling them
+    ingested = [sensors.esp]
+    if config.polling_enabled:
+        ingested += [*sensors.tuya, *sensors.shelly]
+    engine = RuleEngine(on_alert=deliver_alert)
+    for sensor in sensors.devices:
+        rules = []
+        if sensor in ingested:
+            rules.append(
+                StaleSensor(
+                    config.alert_stale_minutes * 60,
+                    last_reading=lambda sensor=sensor: last_reading_time(sensor),
                 )
-            ],
-        ),
-    ]
-)
+            )
+        if sensor.alert_temperature_field is not None:
+            rules.append(
+                SustainedBelow(
+                    sensor.alert_temperature_field,
+                    config.temp_warn_limit,
+                    config.alert_sustained_minutes * 60,
+                    hysteresis=config.alert_hysteresis,
+                    cooldown=config.alert_cooldown,
+                )
+            )
+            rules.append(
+                FallingRate(
+                    sensor.alert_temperature_field,
+                    config.alert_max_drop_per_hour,
+                    config.alert_drop_window_minutes * 60,
+                )
+            )
+        if sensor.alert_power_field is not None:
+            rules.append(
+                PowerSpike(
+                    sensor.alert_power_field,
+                    config.alert_power_spike_factor,
+                    config.alert_power_spike_min_watts,
+                )
+            )
+        engine.add_rules(sensor.name, rules)
+    return engine
+
+
+def ensure_indexes() -> None:
+    for device in get_sensors().devices:
+        try:
+            device.ensure_indexes()
+        except Exception as e:
+            print(f"Failed to create the indexes of {device.name}: {e}")
+
+
+def build_layout():
+    from dash import dcc, html
+
+    return html.Div(
+        children=[
+            html.Div(
+                className="card",
+                children=[
+                    html.H1("Ob der Baechi", className="card-title"),
+                    html.Hr(),
+                    html.P(
+                        children=[
+                            "Sauce: ",
+                            html.A(
+                                "GitHub",
+                                href="https://github.com/JulianKlug/TemperatureSensorApp",
+                                target="_blank",  # Open in new tab
+                            ),
+                            html.Div(
+                                [
+                                    html.Br(),
+                                    html.Br(),
+                                    html.Label("Start Date: "),
+                                    dcc.DatePickerSingle(
+                                        id="start-date-picker",
+                                        date=(datetime.now() - timedelta(days=1)).date(),
+                                        display_format="YYYY-MM-DD",
+                                        style={"margin-right": "40px"},
+                                    ),
+                                    html.Label("End Date: "),
+                                    dcc.DatePickerSingle(
+                                        id="end-date-picker",
+                                        # Default to tomorrow's date to get all entries from today
+                                        date=(datetime.now() + timedelta(days=1)).date(),
+                                        display_format="YYYY-MM-DD",
+                                        style={"margin-right": "40px"},
+                                    ),
+                                    dcc.Checklist(
+                                        id="live-mode",
+                                        options=[{"label": " Live updates", "value": "live"}],
+                                        value=["live"],
+                                        inline=True,
+                                        style={"display": "inline-block"},
+                                    ),
+                                ],
+                            ),
+                        ],
+                        className="card-text",
+                    ),
+                ],
+            ),
+            html.Div(
+                id="sensor-cards",
+                children=[
+                    html.Div(f"{device.name} data will appear here.", id=f"{device.uid}")
+                    for device in get_sensors().devices
+                ],
+            ),
+            dcc.Interval(
+                id="interval-component", interval=10 * 1000, n_intervals=0
+            ),  # Updates every 10 seconds
+            # Add Ceyna at the bottom left
+            html.Div(
+                children=[
+                    html.Img(
+                        src="https://github.com/JulianKlug/TemperatureSensorApp/raw/main/ceyna.png",
+                        alt="Ceyna",
+                        style={
+                            "position": "fixed",
+                            "bottom": "10px",
+                            "right": "10px",
+                            "width": "450px",  # Adjust width as needed
+                        },
+                    )
+                ],
+            ),
+        ]
+    )
 
 
-# Callback to update sensor cards
-@app.callback(
-    Output("sensor-cards", "children"),
-    [
-        Input("start-date-picker", "date"),
-        Input("end-date-picker", "date"),
-    ],
-)
 def update_cards(start_date, end_date):
+    started = time.perf_counter()
     # Convert selected dates to datetime objects
     start_date = (
         datetime.fromisoformat(start_date) if start_date else datetime(2020, 1, 1)
     )
     end_date = datetime.fromisoformat(end_date) if end_date else datetime.now()
+
+    # Render all cards concurrently, the response waits for the slowest one
+    devices = get_sensors().devices
+    futures = [
+        get_card_executor().submit(sensor.get_cached_card, start_date, end_date)
+        for sensor in devices
+    ]
+    deadline = time.monotonic() + get_config().card_timeout
     card_htmls = []
-    for sensor in DEVICES:
-        card_content = sensor.get_card(start_date, end_date)
+    for sensor, future in zip(devices, futures):
+        try:
+            card_content = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            card_content = sensor.get_degraded_card(
+                "Data is taking too long to load, please try again later."
+            )
+        except Exception as e:
+            print(f"Failed to render the card of {sensor.name}: {e}")
+            card_content = sensor.get_degraded_card("Data could not be loaded.")
         # Append the card and graph to the layout
         card_htmls.append(card_content)
+    RENDER_SECONDS.observe(
+        time.perf_counter() - started, view="update_cards", sensor="all"
+    )
     return card_htmls
 
 
+@lazy
+def get_tuya_client():
+    # Long-lived client, the access token is reused between polls
+    from utils.tuya_client import TuyaClient
+
+    config = get_config()
+    return TuyaClient(
+        "https://openapi.tuyaeu.com", config.tuya_access_id, config.tuya_access_key
+    )
+
+
 def log_tuya_values():
-    API_ENDPOINT = "https://openapi.tuyaeu.com"
-    # Init OpenAPI and connect
-    openapi = TuyaOpenAPI(API_ENDPOINT, CONFIG.tuya_access_id, CONFIG.tuya_access_key)
-    openapi.connect()
+    # One batched status request for all Tuya devices
+    job = get_poll_scheduler().job("Tuya")
+    tuya_devices = get_sensors().tuya
+    started = time.perf_counter()
+    try:
+        statuses = get_tuya_client().device_statuses(
+            [device.device_id for device in tuya_devices]
+        )
+    except Exception as e:
+        for device in tuya_devices:
+            job.device(device.name).record(time.perf_counter() - started, e)
+        raise
+    # the latency of every device includes the shared batch request
+    request_latency = time.perf_counter() - started
+
+    failed_devices = []
+    for device in tuya_devices:
+        started = time.perf_counter()
+        error = None
+        try:
+            device.log_status(statuses[device.device_id])
+        except Exception as e:
+            error = e
+            print(f"Failed to log the status of {device.name}: {e}")
+            INGEST_ERRORS_TOTAL.inc(device=device.name)
+            failed_devices.append(device.name)
+        job.device(device.name).record(
+            request_latency + time.perf_counter() - started, error
+        )
+    if failed_devices:
+        raise RuntimeError(f"Failed to log {', '.join(failed_devices)}")
+
+
+@lazy
+def get_shelly_client():
+    # Long-lived client, its connections are kept alive between polls
+    from utils.shelly_client import ShellyClient
+
+    config = get_config()
+    return ShellyClient(
+        config.shelly_api_url,
+        config.shelly_auth_key,
+        max_workers=config.shelly_workers,
+        requests_per_second=config.shelly_requests_per_second,
+    )
+
+
+def log_shelly_values():
+    # The Shelly devices are fetched concurrently, then logged one by one
+    job = get_poll_scheduler().job("Shelly")
+    shelly_devices = get_sensors().shelly
+    shelly_client = get_shelly_client()
+    statuses = shelly_client.device_statuses(
+        [device.device_id for device in shelly_devices]
+    )
+
+    failed_devices = []
+    for device in shelly_devices:
+        started = time.perf_counter()
+        error = None
+        try:
+            status = statuses[device.device_id]
+            if isinstance(status, Exception):
+                raise status
+            device.log_status(status)
+        except Exception as e:
+            error = e
+            print(f"Failed to log the status of {device.name}: {e}")
+            INGEST_ERRORS_TOTAL.inc(device=device.name)
+            failed_devices.append(device.name)
+        job.device(device.name).record(
+            shelly_client.latencies.get(device.device_id, 0.0)
+            + time.perf_counter()
+            - started,
+            error,
+        )
+    if failed_devices:
+        raise RuntimeError(f"Failed to log {', '.join(failed_devices)}")
+
+
+def compact_history(max_batches: int = None) -> int:
+    # Deletes the readings past their retention, a run stops after max_batches
+    # batches and the next one carries on
+    config = get_config()
+    storage = get_storage()
+    max_batches = config.compaction_max_batches if max_batches is None else max_batches
+    batches = 0
+    deleted = 0
+    for sensor in get_sensors().devices:
+        for count in storage.compact(sensor, config.compaction_batch_size):
+            deleted += count
+            batches += 1
+            if batches >= max_batches:
+                return deleted
+            # leave the database to the live ingest between batches
+            time.sleep(config.compaction_pause)
+            while get_write_buffer().pending() >= config.write_batch_size:
+                time.sleep(config.compaction_pause)
+    return deleted
+
+
+@lazy
+def get_poll_scheduler() -> PollScheduler:
+    # The cloud APIs are polled in the background, not on the ingest path
+    config = get_config()
+    poll_scheduler = PollScheduler()
+    polling_jobs = [
+        poll_scheduler.add_job("Tuya", config.tuya_poll_interval, log_tuya_values),
+        poll_scheduler.add_job(
+            "Shelly", config.shelly_poll_interval, log_shelly_values
+        ),
+    ]
+    # the stale sensor rules depend on the time, not on the readings
+    poll_scheduler.add_job(
+        "Alerts", config.alert_check_interval, lambda: get_rule_engine().check()
+    )
+    if config.retention_days and config.compaction_enabled:
+        poll_scheduler.add_job(
+            "Compaction", config.compaction_interval, compact_history
+        )
+    # polling_enabled only turns off the cloud APIs, the other jobs always run
+    poll_scheduler.start(
+        [
+            job
+            for job in poll_scheduler.jobs
+            if config.polling_enabled or job not in polling_jobs
+        ]
+    )
+    return poll_scheduler
+
+
+def register_callbacks(app) -> None:
+    from dash import Input, Output, State
+
+    # Callback to update sensor cards
+    app.callback(
+        Output("sensor-cards", "children"),
+        [
+            Input("start-date-picker", "date"),
+            Input("end-date-picker", "date"),
+        ],
+    )(update_cards)
+
+    # Callbacks appending new readings to the graphs of the rendered cards
+    for device in get_sensors().devices:
+        app.callback(
+            [
+                Output(f"{device.uid}-graph", "extendData"),
+                Output(f"{device.uid}-last-seen", "data"),
+            ],
+            [Input("interval-component", "n_intervals")],
+            [
+                State("live-mode", "value"),
+                State("end-date-picker", "date"),
+                State(f"{device.uid}-last-seen", "data"),
+            ],
+        )(device.extend_live_graph)
+
+
+def register_routes(server) -> None:
+    from flask import Response, jsonify, request, stream_with_context
+
+    @server.route("/cache-stats")
+    def cache_stats():
+        return jsonify(get_card_cache().stats())
+
+    @server.route("/poll-stats")
+    def poll_stats():
+        return jsonify(get_poll_scheduler().stats())
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    @server.route("/export/<collection_name>")
+    def export(collection_name):
+        # Streamed in batches, the memory use does not depend on the range
+        sensor = next(
+            (
+                sensor
+                for sensor in get_sensors().devices
+                if sensor.collection_name == collection_name
+            ),
+            None,
+        )
+        if sensor is None:
+            return f"Unknown sensor {collection_name}.", 404
+        export_format = request.args.get("format", "csv")
+        if export_format not in FORMATS:
+            return f"Unknown format {export_format}, use {', '.join(FORMATS)}.", 400
+        try:
+            start_date = datetime.fromisoformat(request.args.get("start", "2020-01-01"))
+            end = request.args.get("end")
+            end_date = datetime.fromisoformat(end) if end else datetime.now()
+        except ValueError as e:
+            return f"Invalid date: {e}", 400
+
+        batches = sensor.export(start_date, end_date, get_config().export_batch_size)
+        columns = list(sensor.export_fields or sensor.rollup_fields)
+        if export_format == "csv":
+            chunks = csv_chunks(batches, columns)
+        else:
+            chunks = parquet_chunks(batches, columns)
+        filename = f"{collection_name}_{start_date:%Y%m%d}_{end_date:%Y%m%d}"
+        return Response(
+            stream_with_context(chunks),
+            mimetype=FORMATS[export_format],
+            headers={
+                "Content-Disposition": (
+                    f'attachment; filename="{filename}.{export_format}"'
+                )
+            },
+        )
+
+    @server.route("/data", methods=["POST"])
+    def handle_data():
+        esp_sensor = get_sensors().esp
+        try:
+            esp_sensor.log_status(request)
+        except Exception:
+            INGEST_ERRORS_TOTAL.inc(device=esp_sensor.name)
+            raise
+
+        return "Data inserted into database.", 200
+
+
+def create_app():
+    """Build the dashboard, the database is only connected on the first request."""
+    import dash
+
+    # the live graphs only exist once update_cards rendered the cards
+    app = dash.Dash(
+        __name__,
+        requests_pathname_prefix="/buerchen/",
+        suppress_callback_exceptions=True,
+    )
+    app.title = "Ob der Baechi"
+    # rebuilt on every page load, the default dates follow the current day
+    app.layout = build_layout
+    register_callbacks(app)
+    register_routes(app.server)
+    register_compression(app.server, get_config().compression_min_bytes)
 
-    for device in TUYA_DEVICES:
-        device.log_status(openapi)
+    # created in the background, a slow database does not delay the startup
+    Thread(target=ensure_indexes, name="ensure-indexes", daemon=True).start()
+    get_poll_scheduler()
+    return app
 
 
-@app.server.route("/data", methods=["POST"])
-def handle_data():
-    ESP_SENSOR.log_status(request)
-    ShellyPowerSensor().log_status()
+# temperature_app:app / temperature_app:server keep working for WSGI servers
+get_app = lazy(create_app)
 
-    log_tuya_values()
 
-    return "Data inserted into database.", 200
+def __getattr__(name: str):
+    if name == "app":
+        return get_app()
+    if name == "server":
+        return get_app().server
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    app.run_server(debug=False, host="0.0.0.0", port=CONFIG.flask_port)
+    get_app().run(debug=False, host="0.0.0.0", port=get_config().flask_port)
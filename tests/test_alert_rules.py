@@ -0,0 +1,139 @@
+import time
+from datetime import datetime, timezone
+
+from utils.alert_rules import (
+    FallingRate,
+    PowerSpike,
+    RuleEngine,
+    StaleSensor,
+    SustainedBelow,
+)
+
+
+def fired(rule, readings, field="temperature") -> list[bool]:
+    # Whether every (date, value) reading raised an alert
+    return [
+        rule.evaluate("sensor", date, {field: value}) is not None
+        for date, value in readings
+    ]
+
+
+def test_sustained_below_waits_for_the_duration():
+    rule = SustainedBelow("temperature", limit=5, duration=600)
+    readings = [(0, 4), (300, 4), (500, 6), (600, 4), (900, 4), (1200, 3), (1300, 2)]
+    # the reading back above the limit restarts the duration
+    assert fired(rule, readings) == [False, False, False, False, False, True, False]
+
+
+def test_sustained_below_rearms_above_the_hysteresis():
+    rule = SustainedBelow("temperature", limit=5, hysteresis=1)
+    readings = [(0, 4), (60, 3), (120, 5.5), (180, 4), (240, 7), (300, 4)]
+    assert fired(rule, readings) == [True, False, False, False, False, True]
+
+
+def test_sustained_below_cooldown():
+    rule = SustainedBelow("temperature", limit=5, hysteresis=1, cooldown=3600)
+    readings = [(0, 4), (240, 7), (300, 4), (600, 4), (4000, 7), (4100, 4)]
+    # re-armed at 240 but within the cooldown, the next low reading after it fires
+    assert fired(rule, readings) == [True, False, False, False, False, True]
+
+
+def test_sustained_below_ignores_missing_values():
+    rule = SustainedBelow("temperature", limit=5)
+    readings = [(0, None), (60, float("nan")), (120, True), (180, 4)]
+    assert fired(rule, readings) == [False, False, False, True]
+
+
+def test_falling_rate_needs_half_the_window():
+    rule = FallingRate("temperature", max_drop=3, window=3600)
+    readings = [(t, 20 - t / 300) for t in range(0, 1800, 300)]
+    assert not any(fired(rule, readings))
+
+
+def test_falling_rate_rearms_once_the_rate_is_below():
+    rule = FallingRate("temperature", max_drop=3, window=3600)
+    # 6 degrees per hour, every 5 minutes
+    readings = [(t, 20 - t / 600) for t in range(0, 2400, 300)]
+    assert fired(rule, readings) == [False] * 6 + [True, False]
+
+    # flat, the readings of the first slots leave the window and the rate drops
+    flat = [(t, 16.5) for t in range(2400, 4200, 300)]
+    assert not any(fired(rule, flat))
+    assert fired(rule, [(4200, 10)]) == [True]
+
+
+def test_falling_rate_slow_fall():
+    rule = FallingRate("temperature", max_drop=3, window=3600)
+    readings = [(t, 20 - t / 3600) for t in range(0, 7200, 300)]
+    assert not any(fired(rule, readings))
+
+
+def test_power_spike_waits_for_the_warmup():
+    rule = PowerSpike("power", factor=3, min_increase=2000, warmup=12)
+    readings = [(i, 5000 if i == 4 else 500) for i in range(12)]
+    assert not any(fired(rule, readings, "power"))
+    assert fired(rule, [(12, 5000)], "power") == [True]
+
+
+def test_power_spike_rearms_below_the_spike():
+    rule = PowerSpike("power", factor=3, min_increase=2000, warmup=2)
+    readings = [(0, 500), (1, 500), (2, 500), (3, 5000), (4, 5000), (5, 500), (6, 5000)]
+    assert fired(rule, readings, "power") == [False] * 3 + [True, False, False, True]
+
+
+def test_power_spike_needs_the_min_increase():
+    rule = PowerSpike("power", factor=3, min_increase=2000, warmup=2)
+    readings = [(0, 100), (1, 100), (2, 100), (3, 1000)]
+    assert not any(fired(rule, readings, "power"))
+
+
+def test_stale_sensor_without_readings():
+    rule = StaleSensor(timeout=600)
+    assert rule.check("sensor", 10**9) is None
+
+
+def test_stale_sensor_alerts_once_per_gap():
+    rule = StaleSensor(timeout=600)
+    rule.evaluate("sensor", 1000, {})
+    assert rule.check("sensor", 1500) is None
+    alert = rule.check("sensor", 1600)
+    assert alert.rule == "stale_sensor"
+    assert alert.body.endswith(time.strftime("%Y-%m-%d %H:%M", time.localtime(1000)))
+    assert rule.check("sensor", 1700) is None
+
+    rule.evaluate("sensor", 1800, {})
+    assert rule.check("sensor", 2300) is None
+    assert rule.check("sensor", 2400) is not None
+
+
+def test_stale_sensor_asks_for_the_stored_readings():
+    stored = [None]
+    rule = StaleSensor(timeout=600, last_reading=lambda: stored[0])
+    assert rule.check("sensor", 1000) is None
+
+    # logged by another process
+    stored[0] = 900
+    assert rule.check("sensor", 1000) is None
+    assert rule.check("sensor", 1600) is not None
+
+
+def test_rule_engine_delivers_the_alerts():
+    alerts = []
+
+    def on_alert(alert):
+        alerts.append(alert)
+        raise RuntimeError("SMTP is down")
+
+    engine = RuleEngine(on_alert)
+    engine.add_rules("fridge", [SustainedBelow("temperature", 5), StaleSensor(600)])
+    engine.add_rules("freezer", [SustainedBelow("temperature", -30)])
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    engine.evaluate("fridge", {"temperature": 4, "date": date})
+    engine.evaluate("freezer", {"temperature": -20, "date": date})
+    engine.check(date.timestamp() + 600)
+
+    assert [(alert.rule, alert.sensor) for alert in alerts] == [
+        ("sustained_below", "fridge"),
+        ("stale_sensor", "fridge"),
+    ]
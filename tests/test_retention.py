@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import ClassVar
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from utils.mongo_storage import MongoStorage  # noqa: E402
+from utils.rollups import bucket_start  # noqa: E402
+
+NOW = datetime(2024, 6, 15, 13, 30)
+
+
+@dataclass
+class FakeSensor:
+    collection_name: str = "Temperatures"
+    rollup_fields: ClassVar[dict[str, str]] = {"temperature": "temperature"}
+
+
+@pytest.fixture
+def storage():
+    db = mongomock.MongoClient().db
+    return MongoStorage(db, write_buffer=None, retention={"raw": 30, "minute": 60})
+
+
+def insert_readings(storage, sensor, day: datetime, count: int) -> None:
+    storage.collection(sensor).insert_many(
+        [
+            {"temperature": 20.0 + i, "date": day + timedelta(minutes=i)}
+            for i in range(count)
+        ]
+    )
+
+
+def test_retention_cutoff_is_a_whole_day(storage):
+    assert storage.retention_cutoff("raw", NOW) == datetime(2024, 5, 16)
+    assert storage.retention_cutoff("minute", NOW) == datetime(2024, 4, 16)
+    assert storage.retention_cutoff("hour", NOW) is None
+
+
+def test_retained_resolution():
+    storage = MongoStorage(
+        mongomock.MongoClient().db,
+        write_buffer=None,
+        retention={"raw": 30, "minute": 60},
+    )
+    now = datetime.utcnow()
+    assert storage.retained_resolution(now - timedelta(days=10), None) is None
+    assert storage.retained_resolution(now - timedelta(days=10), "hour") == "hour"
+    assert storage.retained_resolution(now - timedelta(days=45), None) == "minute"
+    assert storage.retained_resolution(now - timedelta(days=80), None) == "hour"
+    assert storage.retained_resolution(now - timedelta(days=80), "day") == "day"
+
+
+def test_retained_resolution_without_retention():
+    storage = MongoStorage(mongomock.MongoClient().db, write_buffer=None)
+    assert storage.retained_resolution(datetime(2000, 1, 1), None) is None
+
+
+def test_compact_rebuilds_incomplete_rollups_before_deleting(storage, monkeypatch):
+    sensor = FakeSensor()
+    day = datetime(2024, 4, 1)
+    insert_readings(storage, sensor, day, 10)
+    # the day rollup misses readings, e.g. history older than the rollups
+    storage.rollup_collection(sensor, "day").insert_one({"date": day, "count": 4})
+
+    merged = []
+
+    def merge_rollups(sensor, resolution, match=None):
+        merged.append((resolution, storage.collection(sensor).count_documents(match)))
+
+    monkeypatch.setattr(storage, "merge_rollups", merge_rollups)
+    deleted = sum(storage.compact(sensor, batch_size=3, now=NOW))
+
+    # the minute rollups of the day are past their retention, not rebuilt
+    assert merged == [("hour", 10), ("day", 10)]
+    assert deleted == 10
+    assert storage.collection(sensor).count_documents({}) == 0
+
+
+def test_compact_keeps_complete_rollups(storage, monkeypatch):
+    sensor = FakeSensor()
+    old_day = datetime(2024, 5, 1)
+    recent_day = datetime(2024, 6, 1)
+    insert_readings(storage, sensor, old_day, 5)
+    insert_readings(storage, sensor, recent_day, 5)
+    storage.rollup_collection(sensor, "day").insert_many(
+        [{"date": old_day, "count": 5}, {"date": recent_day, "count": 5}]
+    )
+    storage.rollup_collection(sensor, "minute").insert_many(
+        [{"date": datetime(2024, 3, 1)}, {"date": datetime(2024, 5, 1)}]
+    )
+    monkeypatch.setattr(
+        storage, "merge_rollups", lambda *args: pytest.fail("rollups rebuilt")
+    )
+
+    deleted = sum(storage.compact(sensor, batch_size=2, now=NOW))
+
+    # the raw readings of the old day and the expired minute rollup
+    assert deleted == 6
+    remaining = storage.collection(sensor).find({}, {"date": 1})
+    assert {bucket_start(d["date"], "day") for d in remaining} == {recent_day}
+    assert storage.rollup_collection(sensor, "day").count_documents({}) == 2
+    assert storage.rollup_collection(sensor, "minute").count_documents({}) == 1
+
+
+def test_compact_resumes_after_a_partial_run(storage):
+    sensor = FakeSensor()
+    day = datetime(2024, 4, 1)
+    insert_readings(storage, sensor, day, 10)
+    storage.rollup_collection(sensor, "day").insert_one({"date": day, "count": 10})
+
+    batches = storage.compact(sensor, batch_size=4, now=NOW)
+    assert next(batches) == 4
+    batches.close()
+
+    # fewer raw readings than rolled up, the rollups are not rebuilt
+    assert sum(storage.compact(sensor, batch_size=4, now=NOW)) == 6
+    day_rollup = storage.rollup_collection(sensor, "day").find_one({"date": day})
+    assert day_rollup["count"] == 10
+
+
+def test_compact_timeseries_needs_mongodb_7(storage):
+    storage.timeseries = True
+    with pytest.raises(RuntimeError, match="MongoDB 7.0"):
+        list(storage.compact(FakeSensor(), batch_size=10, now=NOW))
@@ -0,0 +1,117 @@
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+mongomock = pytest.importorskip("mongomock")
+
+from utils.write_buffer import WriteBuffer  # noqa: E402
+
+
+class FlakyCollection:
+    """Collection losing its connection on the first failures bulk writes."""
+
+    name = "flaky"
+
+    def __init__(self, collection, failures: int):
+        self.collection = collection
+        self.failures = failures
+        self.attempts = 0
+
+    def bulk_write(self, operations, ordered=True):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise AutoReconnect("connection lost")
+        return self.collection.bulk_write(operations, ordered=ordered)
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.readings
+
+
+@pytest.fixture
+def write_buffer():
+    write_buffer = WriteBuffer(batch_size=100, flush_interval=60, retry_delay=0)
+    yield write_buffer
+    write_buffer.close()
+
+
+def test_retries_a_lost_connection(write_buffer, collection):
+    flaky = FlakyCollection(collection, failures=2)
+    written = []
+    for i in range(3):
+        write_buffer.insert(flaky, {"value": i}, callback=lambda i=i: written.append(i))
+    write_buffer.close()
+
+    assert flaky.attempts == 3
+    assert collection.count_documents({}) == 3
+    assert written == [0, 1, 2]
+    assert (write_buffer.written, write_buffer.failed) == (3, 0)
+
+
+def test_drops_the_batch_after_the_retries(collection):
+    write_buffer = WriteBuffer(flush_interval=60, max_retries=2, retry_delay=0)
+    flaky = FlakyCollection(collection, failures=5)
+    written = []
+    write_buffer.insert(flaky, {"value": 1}, callback=lambda: written.append(1))
+    write_buffer.close()
+
+    assert flaky.attempts == 3
+    assert written == []
+    assert (write_buffer.written, write_buffer.failed) == (0, 1)
+
+
+def test_counts_only_the_rejected_inserts(write_buffer, collection):
+    collection.insert_one({"_id": 1})
+    written = []
+    for i in range(3):
+        write_buffer.insert(
+            collection, {"_id": i, "value": i}, callback=lambda i=i: written.append(i)
+        )
+    write_buffer.close()
+
+    assert written == [0, 2]
+    assert (write_buffer.written, write_buffer.failed) == (2, 1)
+    assert collection.find_one({"_id": 1}) == {"_id": 1}
+
+
+def test_ordered_writes_continue_after_a_rejected_one(write_buffer):
+    class RejectingCollection:
+        # rejects the second update, an ordered write stops there
+        name = "rollups"
+        written = []
+
+        def bulk_write(self, operations, ordered=True):
+            for index, operation in enumerate(operations):
+                if operation is rejected:
+                    error = {"index": index, "code": 2, "errmsg": "rejected"}
+                    raise BulkWriteError({"writeErrors": [error]})
+                self.written.append(operation)
+
+    operations = [UpdateOne({"_id": i}, {"$inc": {"count": 1}}) for i in range(4)]
+    rejected = operations[1]
+    rollups = RejectingCollection()
+    for operation in operations:
+        write_buffer.add(rollups, operation)
+    write_buffer.close()
+
+    assert rollups.written == [operations[0], *operations[2:]]
+    assert (write_buffer.written, write_buffer.failed) == (3, 1)
+
+
+def test_a_retried_insert_is_not_written_twice(write_buffer, collection):
+    class LostReply(FlakyCollection):
+        # the first attempt is written, but its reply is lost
+        def bulk_write(self, operations, ordered=True):
+            self.attempts += 1
+            result = self.collection.bulk_write(operations, ordered=ordered)
+            if self.attempts <= self.failures:
+                raise AutoReconnect("connection lost")
+            return result
+
+    lost_reply = LostReply(collection, failures=1)
+    write_buffer.insert(lost_reply, {"value": 1})
+    write_buffer.close()
+
+    assert collection.count_documents({}) == 1
+    assert (write_buffer.written, write_buffer.failed) == (1, 0)
@@ -1,33 +1,142 @@
 import smtplib
-from getpass import getpass
+import time
+from email.message import EmailMessage
+from queue import Empty, Full, Queue
+from threading import Thread
+
+from utils.metrics import EXTERNAL_CALL_SECONDS
+
+# tells the worker to send what is queued and stop
+_CLOSE = object()
 
 
 class NotificationSystem:
-    def __init__(self, email_address: str, recipient_addresses: list[str]):
-        self.be_notified = True
+    """Email notifications sent by a background worker.
+
+    notify() only queues the message. The worker waits digest_interval seconds
+    for more messages and sends all of them as one email to all recipients,
+    over an SMTP session it keeps open until idle_timeout seconds without
+    messages. Without a password nothing is sent.
+    """
+
+    def __init__(
+        self,
+        email_address: str,
+        recipient_addresses: list[str],
+        password: str = None,
+        smtp_host: str = 'smtp.gmail.com',
+        smtp_port: int = 587,
+        digest_interval: float = 60.0,
+        idle_timeout: float = 300.0,
+        max_pending: int = 1000,
+    ):
         self.email_address = email_address
         self.recipient_addresses = recipient_addresses
-        validation = input('Type `yes or y` if you wish to be notified by email:\t')
-        if validation not in ['yes', 'y']:
-            self.be_notified = False
-            return
-        message = f'Email password for {self.email_address} :'
-        self.password = getpass(message)
+        self.password = password
+        self.be_notified = bool(password and recipient_addresses)
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.digest_interval = digest_interval
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._smtp = None
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = None
+        if self.be_notified:
+            self._thread = Thread(target=self._run, name='notifications', daemon=True)
+            self._thread.start()
 
     def notify(self, title: str, body: str):
-        for recipient_address in self.recipient_addresses:
-            self._send_message(title, body, recipient_address)
-
-    def _send_message(self, title, body, recipient_address: str):
         if not self.be_notified:
             return
+        try:
+            self._queue.put_nowait((title, body))
+        except Full:
+            # the ingest path never waits for the mail server
+            self.dropped += 1
+
+    def close(self, timeout: float = None):
+        # Send the queued messages and stop the worker
+        if self._thread is None:
+            return
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+        self._thread = None
 
-        smtp_server = smtplib.SMTP('smtp.gmail.com', 587)
-        smtp_server.ehlo()
-        smtp_server.starttls()
-        smtp_server.login(self.email_address, self.password)
-        content = f'Subject: {title}' + '\n' + body
-        smtp_server.sendmail(self.email_address, recipient_address, content)
+    def _run(self):
+        while True:
+            try:
+                # the session is closed after idle_timeout without messages
+                item = self._queue.get(timeout=self.idle_timeout if self._smtp else None)
+            except Empty:
+                self._disconnect()
+                continue
+            if item is _CLOSE:
+                self._disconnect()
+                return
 
-        smtp_server.quit()
-        print('Email sent successfully')
+            # collect the messages of the next digest_interval into one digest
+            messages = [item]
+            closing = False
+            deadline = time.monotonic() + self.digest_interval
+            while not closing:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                else:
+                    messages.append(item)
+
+            self._send_digest(messages)
+            if closing:
+                self._disconnect()
+                return
+
+    def _send_digest(self, messages: list[tuple[str, str]]):
+        if len(messages) == 1:
+            title, body = messages[0]
+        else:
+            title = f'{len(messages)} notifications: {messages[0][0]}'
+            body = '\n\n'.join(f'{title}\n{body}' for title, body in messages)
+
+        message = EmailMessage()
+        message['Subject'] = title
+        message['From'] = self.email_address
+        message['To'] = ', '.join(self.recipient_addresses)
+        message.set_content(body)
+
+        # a kept session may have been closed by the server, retry on a new one
+        for _ in range(2):
+            try:
+                self._send_message(message)
+                self.sent += len(messages)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self._disconnect()
+                error = e
+        self.failed += len(messages)
+        print(f'Failed to send {len(messages)} notifications: {error}')
+
+    def _send_message(self, message: EmailMessage):
+        if self._smtp is None:
+            with EXTERNAL_CALL_SECONDS.time(service='smtp', operation='connect'):
+                smtp_server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+                smtp_server.ehlo()
+                smtp_server.starttls()
+                smtp_server.login(self.email_address, self.password)
+            self._smtp = smtp_server
+        with EXTERNAL_CALL_SECONDS.time(service='smtp', operation='send'):
+            self._smtp.send_message(message)
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
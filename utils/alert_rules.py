@@ -0,0 +1,284 @@
+"""
+Streaming alert rules, evaluated on every reading as it is logged.
+
+Every rule instance watches one field of one sensor and keeps a fixed amount
+of state (a few numbers or a small ring buffer), so evaluating a reading costs
+the same whatever the length of the history. Dates are epoch seconds.
+"""
+import math
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable
+
+from utils.rollups import get_path
+
+
+@dataclass
+class Alert:
+    rule: str
+    sensor: str
+    title: str
+    body: str
+
+
+class Rule:
+    name: str = None
+
+    def evaluate(self, sensor: str, date: float, document: dict) -> Alert:
+        return None
+
+    def check(self, sensor: str, now: float) -> Alert:
+        # Called periodically, for the rules depending on the time only
+        return None
+
+    def _value(self, document: dict, field: str) -> float:
+        value = get_path(document, field)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return None
+        return None if math.isnan(value) else float(value)
+
+
+class SustainedBelow(Rule):
+    """Alert once a field stayed below limit for duration seconds (0 at once).
+
+    The rule alerts again once the field was back at limit + hysteresis, at
+    the earliest cooldown seconds after its previous alert.
+    """
+
+    name = "sustained_below"
+
+    def __init__(
+        self,
+        field: str,
+        limit: float,
+        duration: float = 0.0,
+        hysteresis: float = 0.0,
+        cooldown: float = 0.0,
+    ):
+        self.field = field
+        self.limit = limit
+        self.duration = duration
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self._below_since = None
+        self._alerted = False
+        self._last_alert = None
+
+    def evaluate(self, sensor, date, document):
+        value = self._value(document, self.field)
+        if value is None:
+            return None
+        if value >= self.limit:
+            self._below_since = None
+            if value >= self.limit + self.hysteresis:
+                self._alerted = False
+            return None
+        if self._below_since is None:
+            self._below_since = date
+        if self._alerted or date - self._below_since < self.duration:
+            return None
+        if self._last_alert is not None and date - self._last_alert < self.cooldown:
+            return None
+        self._alerted = True
+        self._last_alert = date
+        title = f"Temperature of {sensor} is below {self.limit}"
+        if self.duration:
+            title += f" for {self.duration / 60:.0f} minutes"
+        return Alert(self.name, sensor, title, f"{self.field} is {value}")
+
+
+class FallingRate(Rule):
+    """Alert when a field falls faster than max_drop per hour over window seconds.
+
+    The window is split in slots, a ring buffer keeps the first reading of
+    each slot. The rate is measured from the oldest reading still in the
+    window to the latest one.
+    """
+
+    name = "falling_rate"
+
+    def __init__(self, field: str, max_drop: float, window: float, slots: int = 12):
+        self.field = field
+        self.max_drop = max_drop
+        self.window = window
+        self.slot_length = window / slots
+        # (slot number, date, value) of the first reading of every slot
+        self._ring = [None] * slots
+        self._alerted = False
+
+    def evaluate(self, sensor, date, document):
+        value = self._value(document, self.field)
+        if value is None:
+            return None
+        slot = int(date // self.slot_length)
+        index = slot % len(self._ring)
+        if self._ring[index] is None or self._ring[index][0] != slot:
+            self._ring[index] = (slot, date, value)
+
+        oldest = min(
+            (
+                entry
+                for entry in self._ring
+                if entry is not None and entry[0] > slot - len(self._ring)
+            ),
+            key=lambda entry: entry[1],
+        )
+        elapsed = date - oldest[1]
+        # a rate over a fraction of the window is mostly noise
+        if elapsed < self.window / 2:
+            return None
+        drop_per_hour = (oldest[2] - value) / elapsed * 3600
+        if drop_per_hour < self.max_drop:
+            self._alerted = False
+            return None
+        if self._alerted:
+            return None
+        self._alerted = True
+        return Alert(
+            self.name,
+            sensor,
+            f"{sensor} is falling {drop_per_hour:.1f} per hour",
+            f"{self.field} went from {oldest[2]} to {value} "
+            f"in {elapsed / 60:.0f} minutes",
+        )
+
+
+class StaleSensor(Rule):
+    """Alert when a sensor logged no reading for timeout seconds.
+
+    Readings may be logged by another process: once the readings seen here
+    are stale, last_reading (the date of the latest stored reading, None
+    without any) is asked before alerting. A sensor without any reading does
+    not alert.
+    """
+
+    name = "stale_sensor"
+
+    def __init__(self, timeout: float, last_reading: Callable[[], float] = None):
+        self.timeout = timeout
+        self.last_reading = last_reading
+        self._last_reading = None
+        self._alerted = False
+
+    def _seen(self, date: float) -> None:
+        if self._last_reading is None or date > self._last_reading:
+            self._last_reading = date
+            self._alerted = False
+
+    def evaluate(self, sensor, date, document):
+        self._seen(date)
+        return None
+
+    def _stale(self, now: float) -> bool:
+        return self._last_reading is None or now - self._last_reading >= self.timeout
+
+    def check(self, sensor, now):
+        if self._stale(now) and self.last_reading is not None:
+            stored = self.last_reading()
+            if stored is not None:
+                self._seen(stored)
+        if self._last_reading is None or self._alerted or not self._stale(now):
+            return None
+        self._alerted = True
+        last_reading = time.localtime(self._last_reading)
+        return Alert(
+            self.name,
+            sensor,
+            f"{sensor} sent no reading for {self.timeout / 60:.0f} minutes",
+            f"Last reading at {time.strftime('%Y-%m-%d %H:%M', last_reading)}",
+        )
+
+
+class PowerSpike(Rule):
+    """Alert when a field jumps to factor times its moving average.
+
+    The jump must also be at least min_increase. The average is exponentially
+    weighted, every reading moves it by alpha.
+    """
+
+    name = "power_spike"
+
+    def __init__(
+        self,
+        field: str,
+        factor: float,
+        min_increase: float,
+        alpha: float = 0.05,
+        warmup: int = 12,
+    ):
+        self.field = field
+        self.factor = factor
+        self.min_increase = min_increase
+        self.alpha = alpha
+        self.warmup = warmup
+        self._average = None
+        self._count = 0
+        self._alerted = False
+
+    def evaluate(self, sensor, date, document):
+        value = self._value(document, self.field)
+        if value is None:
+            return None
+        average = self._average
+        self._count += 1
+        if average is None:
+            self._average = value
+            return None
+        self._average = average + self.alpha * (value - average)
+        if self._count <= self.warmup:
+            return None
+
+        spike = value >= average * self.factor and value - average >= self.min_increase
+        if not spike:
+            self._alerted = False
+            return None
+        if self._alerted:
+            return None
+        self._alerted = True
+        return Alert(
+            self.name,
+            sensor,
+            f"Power spike on {sensor}: {value:.0f} W",
+            f"{self.field} is {value:.0f} W, the average is {average:.0f} W",
+        )
+
+
+class RuleEngine:
+    """Rules of every sensor, alerts are passed to on_alert."""
+
+    def __init__(self, on_alert: Callable[[Alert], None]):
+        self.on_alert = on_alert
+        self._rules = {}
+        self._lock = Lock()
+
+    def add_rules(self, sensor: str, rules: list[Rule]) -> None:
+        self._rules.setdefault(sensor, []).extend(rules)
+
+    def evaluate(self, sensor: str, document: dict) -> None:
+        date = document["date"].timestamp()
+        with self._lock:
+            alerts = [
+                rule.evaluate(sensor, date, document)
+                for rule in self._rules.get(sensor, [])
+            ]
+        self._deliver(alerts)
+
+    def check(self, now: float = None) -> None:
+        now = time.time() if now is None else now
+        with self._lock:
+            alerts = [
+                rule.check(sensor, now)
+                for sensor, rules in self._rules.items()
+                for rule in rules
+            ]
+        self._deliver(alerts)
+
+    def _deliver(self, alerts: list[Alert]) -> None:
+        for alert in alerts:
+            if alert is None:
+                continue
+            try:
+                self.on_alert(alert)
+            except Exception as e:
+                print(f"Failed to deliver the alert {alert.title}: {e}")
@@ -0,0 +1,85 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+def serialized_size(value) -> int:
+    # Size of the value as sent to the browser
+    from plotly.utils import PlotlyJSONEncoder
+
+    return len(json.dumps(value, cls=PlotlyJSONEncoder))
+
+
+class CardCache:
+    """LRU cache of rendered cards keyed by (sensor uid, start date, end date).
+
+    Entries expire after ttl seconds, the least recently used ones are evicted
+    once the serialized size of all entries exceeds max_bytes, and all entries
+    of a sensor are dropped when it logs a new reading.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._generations = {}  # sensor uid -> number of invalidations
+        self._size = 0
+        self._lock = Lock()
+
+    def generation(self, sensor_uid) -> int:
+        with self._lock:
+            return self._generations.get(sensor_uid, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, generation: int) -> None:
+        """Store a card rendered while the sensor was at the given generation."""
+        size = serialized_size(value)
+        with self._lock:
+            # the sensor logged a reading while the card was rendered
+            if self._generations.get(key[0], 0) != generation or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, sensor_uid) -> None:
+        with self._lock:
+            self._generations[sensor_uid] = self._generations.get(sensor_uid, 0) + 1
+            for key in [key for key in self._entries if key[0] == sensor_uid]:
+                self._remove(key)
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def _remove(self, key) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
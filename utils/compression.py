@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "text/",
+)
+
+
+def _encode(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _accepted_encoding(accept_encoding: str):
+    accepted = {
+        part.split(";")[0].strip()
+        for part in accept_encoding.lower().split(",")
+        if not part.strip().endswith(";q=0")
+    }
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def register_compression(server, min_size: int = 500) -> None:
+    """Compress the responses of a Flask server and tag them with an ETag.
+
+    The ETag is a hash of the uncompressed body, a GET whose If-None-Match
+    still matches gets an empty 304. Callback responses (POST) are only
+    compressed, browsers do not revalidate them.
+    """
+    from flask import request
+
+    @server.after_request
+    def compress(response):
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)
+        ):
+            return response
+
+        data = response.get_data()
+        if request.method == "GET" and "ETag" not in response.headers:
+            # weak, the compressed and uncompressed bodies are equivalent
+            etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+            response.set_etag(etag, weak=True)
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = _accepted_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None or len(data) < min_size:
+            return response
+        response.set_data(_encode(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def minmax_indices(values, max_points: int) -> np.ndarray:
+    """Indices of about max_points samples keeping the min and max of each bucket.
+
+    Buckets hold the same number of samples, so spikes and dips survive the
+    reduction. The first and last samples are always kept.
+    """
+    values = np.asarray(values, dtype=float)
+    n_samples = len(values)
+    if max_points < 4 or n_samples <= max_points:
+        return np.arange(n_samples)
+
+    n_buckets = (max_points - 2) // 2
+    bucket_size = -(-n_samples // n_buckets)
+    # pad with the last value so the samples fit in a (n_buckets, bucket_size) grid
+    buckets = np.pad(values, (0, n_buckets * bucket_size - n_samples), mode="edge")
+    buckets = buckets.reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+
+    # NaNs (missing readings) must never win the min / max
+    nan_mask = np.isnan(buckets)
+    min_idx = np.argmin(np.where(nan_mask, np.inf, buckets), axis=1) + offsets
+    max_idx = np.argmax(np.where(nan_mask, -np.inf, buckets), axis=1) + offsets
+
+    # np.unique sorts, which puts the selected samples back in time order
+    return np.unique(
+        np.minimum(
+            np.concatenate([[0], min_idx, max_idx, [n_samples - 1]]), n_samples - 1
+        )
+    )
+
+
+def minmax_downsample(timestamps, *series, max_points: int):
+    """Downsample series sharing the same timestamps to about max_points samples each.
+
+    The selected indices of every series are merged so all traces keep a
+    common x axis.
+    """
+    timestamps = np.asarray(timestamps)
+    series = [np.asarray(values, dtype=float) for values in series]
+    if len(timestamps) <= max_points:
+        return timestamps, *series
+
+    indices = np.unique(
+        np.concatenate(
+            [minmax_indices(values, max_points // len(series)) for values in series]
+        )
+    )
+    return timestamps[indices], *(values[indices] for values in series)
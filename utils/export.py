@@ -0,0 +1,99 @@
+import csv
+import importlib.util
+import io
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from utils.queries import SeriesRange
+
+# export format -> media type, Parquet only with pyarrow installed. pyarrow is
+# imported by the first Parquet export, not with the app.
+FORMATS = {"csv": "text/csv"}
+if importlib.util.find_spec("pyarrow") is not None:
+    FORMATS["parquet"] = "application/vnd.apache.parquet"
+
+
+def _date_strings(dates: np.ndarray) -> np.ndarray:
+    return np.datetime_as_string(dates, unit="ms", timezone="UTC")
+
+
+def csv_chunks(batches: Iterable[SeriesRange], columns: list[str]) -> Iterator[str]:
+    """CSV text of the batches, one chunk per batch, missing values are empty."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["date", *columns])
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        values = []
+        for column in (batch.columns[name] for name in columns):
+            strings = column.astype(str)
+            strings[np.isnan(column)] = ""
+            values.append(strings)
+        writer.writerows(zip(_date_strings(batch.dates), *values))
+        yield buffer.getvalue()
+
+
+class _Chunks(io.RawIOBase):
+    # A write-only file handing out what was written since the last take()
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(
+    batches: Iterable[SeriesRange], columns: list[str]
+) -> Iterator[bytes]:
+    """Parquet file of the batches, every batch is written as one row group."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("date", pa.timestamp("ms", tz="UTC")),
+            *((column, pa.float64()) for column in columns),
+        ]
+    )
+    date_type = schema.field("date").type
+    sink = _Chunks()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for batch in batches:
+            writer.write_table(
+                pa.table(
+                    [
+                        pa.array(batch.dates.astype(np.int64), date_type),
+                        # NaN are stored as nulls
+                        *(
+                            pa.array(batch.columns[column], from_pandas=True)
+                            for column in columns
+                        ),
+                    ],
+                    schema=schema,
+                )
+            )
+            yield sink.take()
+    finally:
+        # the footer is written on close, it ends the last chunk
+        writer.close()
+    yield sink.take()
@@ -0,0 +1,19 @@
+import numpy as np
+
+
+def typed_dates(dates) -> np.ndarray:
+    # Milliseconds since the epoch on a date axis, sent as a base64 typed array
+    # instead of one ISO string per point
+    return np.asarray(dates, dtype="datetime64[ms]").astype(np.int64).astype(np.float64)
+
+
+def typed_values(values) -> np.ndarray:
+    # Float32 keeps every digit of the readings at half the size of float64
+    return np.asarray(values, dtype=np.float32)
+
+
+def scatter_trace(points: int, webgl_min_points: int):
+    """Trace class for the number of points, WebGL renders large series faster."""
+    import plotly.graph_objs as go
+
+    return go.Scattergl if points >= webgl_min_points else go.Scatter
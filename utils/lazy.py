@@ -0,0 +1,25 @@
+from functools import wraps
+from threading import Lock
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+
+def lazy(factory: Callable[[], T]) -> Callable[[], T]:
+    """Call factory on first use only and return its result from then on.
+
+    Unlike functools.cache, concurrent first calls wait for a single call of
+    the factory, so clients and background threads are never built twice.
+    """
+    lock = Lock()
+    result = []
+
+    @wraps(factory)
+    def get() -> T:
+        if not result:
+            with lock:
+                if not result:
+                    result.append(factory())
+        return result[0]
+
+    return get
@@ -0,0 +1,182 @@
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Lock
+from typing import Iterator
+
+import numpy as np
+
+from utils.queries import SeriesRange, summarize
+from utils.rollups import get_path
+from utils.storage import Storage
+
+DATE_FILE = "date.i8"
+STATUS_FILE = "status.json"
+
+
+def to_milliseconds(date: datetime) -> int:
+    # Naive dates are UTC, like the dates returned by pymongo
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return int(np.datetime64(date, "ms").astype(np.int64))
+
+
+class LocalStorage(Storage):
+    """Readings in append-only files of a local directory, without a server.
+
+    Every sensor has a directory holding the reading dates (int64 milliseconds
+    since the epoch, UTC), one float64 file per column and its latest reading
+    in status.json. The files are memory-mapped: a range query is a binary
+    search on the dates and returns views of the mapped files, the readings
+    are not copied. Readings have to be appended in date order.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self._lock = Lock()
+        # collection name -> (date file size, dates, columns) of the last mapping
+        self._mappings = {}
+
+    def _directory(self, sensor) -> Path:
+        return self.path / sensor.collection_name
+
+    def _column_file(self, sensor, column: str) -> Path:
+        return self._directory(sensor) / f"{column}.f8"
+
+    def _mapped(self, sensor) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        date_file = self._directory(sensor) / DATE_FILE
+        size = date_file.stat().st_size if date_file.exists() else 0
+        mapping = self._mappings.get(sensor.collection_name)
+        if mapping is not None and mapping[0] == size:
+            return mapping[1:]
+
+        # the dates are written last, a reading is complete once its date is
+        length = size // 8
+        files = {
+            column: self._column_file(sensor, column) for column in sensor.rollup_fields
+        }
+        for file in files.values():
+            length = min(length, file.stat().st_size // 8 if file.exists() else 0)
+
+        if length:
+            dates = np.memmap(date_file, dtype=np.int64, mode="r", shape=(length,))
+            columns = {
+                column: np.memmap(file, dtype=np.float64, mode="r", shape=(length,))
+                for column, file in files.items()
+            }
+        else:
+            dates = np.empty(0, dtype=np.int64)
+            columns = {column: np.empty(0, dtype=np.float64) for column in files}
+        self._mappings[sensor.collection_name] = (size, dates, columns)
+        return dates, columns
+
+    def extend(self, sensor, dates, columns: dict[str, np.ndarray]) -> None:
+        """Append many readings at once, missing columns are stored as NaN."""
+        dates = np.asarray(dates).astype("datetime64[ms]").astype(np.int64)
+        if not len(dates):
+            return
+
+        with self._lock:
+            stored_dates, _ = self._mapped(sensor)
+            if np.any(np.diff(dates) < 0) or (
+                len(stored_dates) and dates[0] < stored_dates[-1]
+            ):
+                raise ValueError(
+                    f"Readings of {sensor.name} must be appended in date order"
+                )
+
+            self._directory(sensor).mkdir(parents=True, exist_ok=True)
+            for column in sensor.rollup_fields:
+                values = np.asarray(
+                    columns.get(column, np.full(len(dates), np.nan)), dtype=np.float64
+                )
+                if len(values) != len(dates):
+                    raise ValueError(f"{column} does not have one value per date")
+                with open(self._column_file(sensor, column), "ab") as f:
+                    f.write(values.tobytes())
+            with open(self._directory(sensor) / DATE_FILE, "ab") as f:
+                f.write(dates.tobytes())
+
+    def append(self, sensor, document: dict, callback=None) -> None:
+        values = {}
+        for column, path in sensor.rollup_fields.items():
+            value = get_path(document, path)
+            values[column] = [np.nan if value is None else value]
+        self.extend(sensor, [to_milliseconds(document["date"])], values)
+        self._write_status(sensor, document)
+        if callback is not None:
+            callback()
+
+    def _write_status(self, sensor, document: dict) -> None:
+        status = {field: document.get(field) for field in sensor.status_fields}
+        date = datetime.fromtimestamp(
+            to_milliseconds(document["date"]) / 1000, timezone.utc
+        )
+        status["date"] = date.replace(tzinfo=None).isoformat()
+        # replaced at once, readers never see a partly written status
+        status_file = self._directory(sensor) / STATUS_FILE
+        temporary_file = status_file.with_suffix(".tmp")
+        with open(temporary_file, "w") as f:
+            json.dump(status, f)
+        os.replace(temporary_file, status_file)
+
+    def latest(self, sensor) -> dict:
+        status_file = self._directory(sensor) / STATUS_FILE
+        if not status_file.exists():
+            return None
+        with open(status_file) as f:
+            status = json.load(f)
+        status["date"] = datetime.fromisoformat(status["date"])
+        return status
+
+    def _series(self, dates, columns, start: int, stop: int, names) -> SeriesRange:
+        # Views of the mapped files, np.asarray drops the memmap subclass
+        series_columns = {name: np.asarray(columns[name][start:stop]) for name in names}
+        return SeriesRange(
+            dates=np.asarray(dates[start:stop]).view("datetime64[ms]"),
+            columns=series_columns,
+            stats={name: summarize(values) for name, values in series_columns.items()},
+        )
+
+    def query_range(
+        self, sensor, start_date: datetime, end_date: datetime, columns: list[str]
+    ) -> SeriesRange:
+        dates, mapped_columns = self._mapped(sensor)
+        start = np.searchsorted(dates, to_milliseconds(start_date), side="left")
+        stop = np.searchsorted(dates, to_milliseconds(end_date), side="right")
+        return self._series(dates, mapped_columns, start, stop, columns)
+
+    def export(
+        self,
+        sensor,
+        start_date: datetime,
+        end_date: datetime,
+        fields: dict[str, str],
+        batch_size: int,
+    ) -> Iterator[SeriesRange]:
+        # Only the rollup fields are stored, the other fields are exported as NaN
+        dates, mapped_columns = self._mapped(sensor)
+        stored = {path: column for column, path in sensor.rollup_fields.items()}
+        start = np.searchsorted(dates, to_milliseconds(start_date), side="left")
+        stop = np.searchsorted(dates, to_milliseconds(end_date), side="right")
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            yield SeriesRange(
+                dates=np.asarray(dates[batch_start:batch_stop]).view("datetime64[ms]"),
+                columns={
+                    column: (
+                        np.asarray(mapped_columns[stored[path]][batch_start:batch_stop])
+                        if path in stored
+                        else np.full(batch_stop - batch_start, np.nan)
+                    )
+                    for column, path in fields.items()
+                },
+            )
+
+    def query_since(
+        self, sensor, after: datetime, columns: list[str], limit: int
+    ) -> SeriesRange:
+        dates, mapped_columns = self._mapped(sensor)
+        start = np.searchsorted(dates, to_milliseconds(after), side="right")
+        return self._series(dates, mapped_columns, start, start + limit, columns)
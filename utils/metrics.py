@@ -0,0 +1,219 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Recording a value takes a lock and a bisect on the buckets, cheap enough to
+stay on in production. The app serves the metrics at /metrics, the collector
+on its own port (see serve).
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a cached Mongo lookup to a BLE connection with retries
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+_metrics = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    kind: str = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            values = {key: self._copy(value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+    def _samples(self, key: tuple, value) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self, key: tuple, value: float) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            # counts per bucket (the last one is +Inf), sum
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        # Observe the duration of the block, also when it raises
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _copy(self, value):
+        return [list(value[0]), value[1]]
+
+    def _samples(self, key: tuple, value) -> list[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(
+                f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+            )
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All metrics of the process in the Prometheus text format."""
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+EXTERNAL_CALL_SECONDS = Histogram(
+    "buerchen_external_call_seconds",
+    "Duration of the calls to the Tuya, Shelly, BLE and SMTP services.",
+    ("service", "operation"),
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "buerchen_mongo_command_seconds",
+    "Duration of the MongoDB commands, e.g. find, getMore, insert or update.",
+    ("command", "collection"),
+)
+RENDER_SECONDS = Histogram(
+    "buerchen_render_seconds",
+    "Duration of get_card for every sensor and of update_cards for all of them.",
+    ("view", "sensor"),
+)
+READINGS_TOTAL = Counter(
+    "buerchen_readings_total", "Readings logged per device.", ("device",)
+)
+ALERTS_TOTAL = Counter(
+    "buerchen_alerts_total", "Alerts raised per rule and device.", ("rule", "device")
+)
+INGEST_ERRORS_TOTAL = Counter(
+    "buerchen_ingest_errors_total",
+    "Readings of a device that could not be read or logged.",
+    ("device",),
+)
+WRITE_ERRORS_TOTAL = Counter(
+    "buerchen_write_errors_total",
+    "Buffered MongoDB writes dropped after the retries, per collection.",
+    ("collection",),
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Observe the duration of every command of the MongoClient it is given to."""
+
+    def __init__(self):
+        # (connection id, request id) -> collection of the commands in flight
+        self._collections = {}
+
+    def started(self, event) -> None:
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _observe(self, event) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.observe(
+            event.duration_micros / 1e6,
+            command=event.command_name,
+            collection=collection,
+        )
+
+    def succeeded(self, event) -> None:
+        self._observe(event)
+
+    def failed(self, event) -> None:
+        self._observe(event)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve the metrics of a process without a web app, in a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
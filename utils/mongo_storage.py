@@ -0,0 +1,322 @@
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from pymongo import InsertOne, UpdateOne
+
+from utils.queries import (
+    SeriesRange,
+    bucket_projection,
+    iter_series,
+    projection,
+    series_from_buckets,
+    series_from_cursor,
+)
+from utils.rollups import (
+    RESOLUTIONS,
+    bucket_start,
+    rollup_pipeline,
+    rollup_update,
+    select_resolution,
+)
+from utils.storage import Storage
+from utils.timeseries import META_FIELD, create_timeseries_collection
+from utils.write_buffer import WriteBuffer
+
+
+class MongoStorage(Storage):
+    """Readings in one MongoDB collection per sensor.
+
+    Readings are written through the write buffer together with their rollups
+    and the status document of the sensor. Range queries read the coarsest
+    rollup that still gives rollup_min_points points for the range.
+
+    retention gives the days the raw readings ("raw") and the rollups of every
+    resolution are kept, tiers without retention are kept forever. Ranges
+    reaching past the raw retention are read from the finest rollup left.
+    Deleting raw readings from time-series collections needs MongoDB 7.0.
+    """
+
+    def __init__(
+        self,
+        db,
+        write_buffer: WriteBuffer,
+        rollup_min_points: int = 500,
+        timeseries: bool = False,
+        timeseries_granularity: str = "minutes",
+        retention: dict[str, float] = None,
+    ):
+        self.db = db
+        self.write_buffer = write_buffer
+        self.rollup_min_points = rollup_min_points
+        self.timeseries = timeseries
+        self.timeseries_granularity = timeseries_granularity
+        self.retention = retention or {}
+        # Latest reading of every sensor, one document per sensor
+        self.status_collection = db["SensorStatus"]
+        self._collections = {}
+
+    def collection(self, sensor):
+        collection = self._collections.get(sensor.collection_name)
+        if collection is None:
+            if self.timeseries:
+                collection = self.timeseries_collection(sensor)
+            else:
+                collection = self.db[sensor.collection_name]
+            self._collections[sensor.collection_name] = collection
+        return collection
+
+    def timeseries_collection(self, sensor):
+        # Created before the first insert, an insert would create a plain collection
+        return create_timeseries_collection(
+            self.db,
+            f"{sensor.collection_name}_timeseries",
+            self.timeseries_granularity,
+        )
+
+    def rollup_collection(self, sensor, resolution: str):
+        return self.db[f"{sensor.collection_name}_{resolution}"]
+
+    def raw_filter(self, sensor, date_condition: dict) -> dict:
+        # The sensor id lets time-series queries use the meta and time index
+        if self.timeseries:
+            return {META_FIELD: sensor.collection_name, "date": date_condition}
+        return {"date": date_condition}
+
+    def append(self, sensor, document: dict, callback=None) -> None:
+        if self.timeseries:
+            document = {**document, META_FIELD: sensor.collection_name}
+        operations = [
+            (self.collection(sensor), InsertOne(document)),
+            *self.rollup_operations(sensor, document),
+            self.status_operation(sensor, document),
+        ]
+        for collection, operation in operations[:-1]:
+            self.write_buffer.add(collection, operation)
+        # the callback waits for the reading and its rollups to be written
+        self.write_buffer.add(*operations[-1], callback=callback)
+
+    def rollup_operations(self, sensor, document: dict) -> list:
+        if not sensor.rollup_fields:
+            return []
+        update = rollup_update(document, sensor.rollup_fields)
+        return [
+            (
+                self.rollup_collection(sensor, resolution),
+                UpdateOne(
+                    {"date": bucket_start(document["date"], resolution)},
+                    update,
+                    upsert=True,
+                ),
+            )
+            for resolution in RESOLUTIONS
+        ]
+
+    def status_operation(self, sensor, document: dict) -> tuple:
+        status = {field: document.get(field) for field in sensor.status_fields}
+        return (
+            self.status_collection,
+            UpdateOne(
+                {"_id": sensor.collection_name},
+                {"$set": {**status, "date": document["date"]}},
+                upsert=True,
+            ),
+        )
+
+    def latest(self, sensor) -> dict:
+        status = self.status_collection.find_one({"_id": sensor.collection_name})
+        if status is None:
+            # no reading was logged since the status documents were introduced
+            status = self.collection(sensor).find_one({}, sort=[("date", -1)])
+        return status
+
+    def merge_rollups(self, sensor, resolution: str, match: dict = None) -> None:
+        # Rebuild the rollups of the raw readings matching match (all without)
+        rollup_collection = self.rollup_collection(sensor, resolution)
+        # $merge on the date needs a unique index on it, even on a fresh database
+        rollup_collection.create_index("date", unique=True)
+        pipeline = rollup_pipeline(
+            sensor.rollup_fields, resolution, rollup_collection.name
+        )
+        if match is not None:
+            pipeline.insert(0, {"$match": match})
+        self.collection(sensor).aggregate(pipeline)
+
+    def backfill_rollups(self, sensor, resolution: str) -> None:
+        # Rebuild the rollups of a resolution from the whole raw history
+        self.merge_rollups(sensor, resolution)
+
+    def ensure_indexes(self, sensor) -> None:
+        if self.timeseries:
+            # already created by MongoDB 6.3+ for new time-series collections
+            self.collection(sensor).create_index([(META_FIELD, 1), ("date", 1)])
+        else:
+            self.collection(sensor).create_index("date")
+        for resolution in RESOLUTIONS:
+            self.rollup_collection(sensor, resolution).create_index(
+                "date", unique=True
+            )
+
+    def query_range(
+        self, sensor, start_date: datetime, end_date: datetime, columns: list[str]
+    ) -> SeriesRange:
+        # Read only the given rolled up columns, sorted by date
+        fields = {column: sensor.rollup_fields[column] for column in columns}
+        date_range = {"$gte": start_date, "$lte": end_date}
+
+        # Read the coarsest rollup that still gives enough points for the range
+        series = None
+        resolution = self.retained_resolution(
+            start_date,
+            select_resolution(start_date, end_date, self.rollup_min_points),
+        )
+        if resolution is not None:
+            series = series_from_buckets(
+                self.rollup_collection(sensor, resolution)
+                .find(
+                    {
+                        "date": {
+                            "$gte": bucket_start(start_date, resolution),
+                            "$lte": end_date,
+                        }
+                    },
+                    bucket_projection(fields),
+                )
+                .sort("date", 1),
+                fields,
+            )
+        if series is None or not len(series):
+            series = series_from_cursor(
+                self.collection(sensor)
+                .find(self.raw_filter(sensor, date_range), projection(fields))
+                .sort("date", 1),
+                fields,
+            )
+        return series
+
+    def export(
+        self,
+        sensor,
+        start_date: datetime,
+        end_date: datetime,
+        fields: dict[str, str],
+        batch_size: int,
+    ) -> Iterator[SeriesRange]:
+        date_range = {"$gte": start_date, "$lte": end_date}
+        return iter_series(
+            self.collection(sensor)
+            .find(self.raw_filter(sensor, date_range), projection(fields))
+            .sort("date", 1),
+            fields,
+            batch_size,
+        )
+
+    def retention_cutoff(self, tier: str, now: datetime = None) -> datetime:
+        """Readings of the tier older than the cutoff are deleted, None keeps all."""
+        days = self.retention.get(tier)
+        if days is None:
+            return None
+        if now is None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+        # whole days, the rollups of a day are checked and rebuilt together
+        return bucket_start(now - timedelta(days=days), "day")
+
+    def retained_resolution(self, start_date: datetime, resolution: str) -> str:
+        """The resolution, or a coarser one still holding the readings at start_date.
+
+        None stands for the raw readings, like for select_resolution.
+        """
+        tiers = ["raw", *RESOLUTIONS]
+        for tier in tiers[tiers.index(resolution or "raw") :]:
+            cutoff = self.retention_cutoff(tier)
+            if cutoff is None or start_date >= cutoff:
+                return None if tier == "raw" else tier
+        # past every retention, the coarsest rollup is read
+        return tiers[-1]
+
+    def compact(self, sensor, batch_size: int, now: datetime = None) -> Iterator[int]:
+        # Raw readings are deleted one day at a time, once the rollups hold the day
+        raw_cutoff = self.retention_cutoff("raw", now)
+        if raw_cutoff is not None and sensor.rollup_fields:
+            if self.timeseries:
+                self._check_timeseries_deletes()
+            collection = self.collection(sensor)
+            while True:
+                oldest = collection.find_one(
+                    self.raw_filter(sensor, {"$lt": raw_cutoff}),
+                    {"date": 1},
+                    sort=[("date", 1)],
+                )
+                if oldest is None:
+                    break
+                day = bucket_start(oldest["date"], "day")
+                day_filter = self.raw_filter(
+                    sensor, {"$gte": day, "$lt": day + RESOLUTIONS["day"]}
+                )
+                self.complete_rollups(sensor, day, day_filter, now)
+                deleted = 0
+                for count in self._delete_batches(collection, day_filter, batch_size):
+                    deleted += count
+                    yield count
+                if not deleted:
+                    # the day would be found again on and on
+                    break
+
+        for resolution in RESOLUTIONS:
+            cutoff = self.retention_cutoff(resolution, now)
+            if cutoff is not None:
+                yield from self._delete_batches(
+                    self.rollup_collection(sensor, resolution),
+                    {"date": {"$lt": cutoff}},
+                    batch_size,
+                )
+
+    def complete_rollups(
+        self, sensor, day: datetime, day_filter: dict, now: datetime = None
+    ) -> None:
+        # Rebuild the rollups of a day counting fewer readings than the raw
+        # collection, e.g. history older than the rollups. A day counting more
+        # is partly deleted already, its rollups are kept.
+        day_rollup = self.rollup_collection(sensor, "day").find_one({"date": day})
+        rolled_up = day_rollup.get("count", 0) if day_rollup else 0
+        if rolled_up >= self.collection(sensor).count_documents(day_filter):
+            return
+        for resolution in RESOLUTIONS:
+            cutoff = self.retention_cutoff(resolution, now)
+            if cutoff is not None and day < cutoff:
+                continue
+            self.merge_rollups(sensor, resolution, day_filter)
+
+    def _check_timeseries_deletes(self) -> None:
+        # Before 7.0, time-series collections are only deleted from by metaField
+        version = self.db.client.server_info()["versionArray"]
+        if version[:2] < [7, 0]:
+            raise RuntimeError(
+                "Deleting readings from time-series collections needs MongoDB 7.0, "
+                f"the server runs {'.'.join(map(str, version[:3]))}"
+            )
+
+    def _delete_batches(self, collection, query: dict, batch_size: int):
+        # delete_many has no limit, the ids of every batch are read first
+        while True:
+            ids = [
+                document["_id"]
+                for document in collection.find(query, {"_id": 1}).limit(batch_size)
+            ]
+            if not ids:
+                return
+            deleted = collection.delete_many({"_id": {"$in": ids}}).deleted_count
+            yield deleted
+            if not deleted:
+                return
+
+    def query_since(
+        self, sensor, after: datetime, columns: list[str], limit: int
+    ) -> SeriesRange:
+        fields = {column: sensor.rollup_fields[column] for column in columns}
+        return series_from_cursor(
+            self.collection(sensor)
+            .find(self.raw_filter(sensor, {"$gt": after}), projection(fields))
+            .sort("date", 1)
+            .limit(limit),
+            fields,
+        )
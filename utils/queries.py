@@ -0,0 +1,133 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils.rollups import get_path
+
+CURSOR_BATCH_SIZE = 10000
+
+
+@dataclass
+class SeriesRange:
+    # Columnar readings of a sensor over a date range
+    dates: np.ndarray
+    columns: dict[str, np.ndarray]
+    # min / max / mean of every column over the whole range
+    stats: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def stat(self, column: str, name: str):
+        value = self.stats.get(column, {}).get(name)
+        return "No data available" if value is None else value
+
+
+def _as_dates(dates) -> np.ndarray:
+    return np.array(dates, dtype="datetime64[ms]")
+
+
+def summarize(values: np.ndarray) -> dict[str, float]:
+    if np.isnan(values).all():
+        return {}
+    return {
+        "min": np.nanmin(values),
+        "max": np.nanmax(values),
+        "mean": np.nanmean(values),
+    }
+
+
+def projection(fields: dict[str, str]) -> dict:
+    return {"_id": 0, "date": 1, **{path: 1 for path in fields.values()}}
+
+
+def series_from_cursor(cursor, fields: dict[str, str]) -> SeriesRange:
+    """Build the columns of projected raw documents in a single pass over the cursor."""
+    dates = []
+    values = {column: [] for column in fields}
+    for document in cursor.batch_size(CURSOR_BATCH_SIZE):
+        dates.append(document["date"])
+        for column, path in fields.items():
+            values[column].append(get_path(document, path))
+
+    columns = {
+        column: np.array(column_values, dtype=float)
+        for column, column_values in values.items()
+    }
+    return SeriesRange(
+        dates=_as_dates(dates),
+        columns=columns,
+        stats={column: summarize(column_values) for column, column_values in columns.items()},
+    )
+
+
+def iter_series(cursor, fields: dict[str, str], batch_size: int):
+    """Columns of projected raw documents, batch_size readings at a time.
+
+    Only one batch is held in memory, the batches have no stats.
+    """
+
+    def batch(documents: list[dict]) -> SeriesRange:
+        return SeriesRange(
+            dates=_as_dates([document["date"] for document in documents]),
+            columns={
+                column: np.array(
+                    [get_path(document, path) for document in documents], dtype=float
+                )
+                for column, path in fields.items()
+            },
+        )
+
+    documents = []
+    for document in cursor.batch_size(batch_size):
+        documents.append(document)
+        if len(documents) == batch_size:
+            yield batch(documents)
+            documents = []
+    if documents:
+        yield batch(documents)
+
+
+def bucket_projection(fields: dict[str, str]) -> dict:
+    return {
+        "_id": 0,
+        "date": 1,
+        **{
+            f"{column}.{stat}": 1
+            for column in fields
+            for stat in ["min", "max", "sum", "count"]
+        },
+    }
+
+
+def series_from_buckets(cursor, fields: dict[str, str]) -> SeriesRange:
+    """Build the columns of rollup buckets, each bucket giving its min then its max."""
+    dates = []
+    stats = {column: {"min": [], "max": [], "sum": [], "count": []} for column in fields}
+    for bucket in cursor.batch_size(CURSOR_BATCH_SIZE):
+        dates.append(bucket["date"])
+        for column, column_stats in stats.items():
+            bucket_stats = bucket.get(column) or {}
+            for name, values in column_stats.items():
+                values.append(bucket_stats.get(name))
+
+    columns = {}
+    range_stats = {}
+    for column, column_stats in stats.items():
+        mins, maxs, sums, counts = (
+            np.array(column_stats[name], dtype=float)
+            for name in ["min", "max", "sum", "count"]
+        )
+        columns[column] = np.column_stack([mins, maxs]).ravel()
+        if np.nansum(counts) > 0:
+            range_stats[column] = {
+                "min": np.nanmin(mins),
+                "max": np.nanmax(maxs),
+                "mean": np.nansum(sums) / np.nansum(counts),
+            }
+
+    return SeriesRange(
+        dates=np.repeat(_as_dates(dates), 2),
+        columns=columns,
+        stats=range_stats,
+    )
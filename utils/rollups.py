@@ -0,0 +1,111 @@
+"""
+Pre-aggregated rollups of the raw sensor collections.
+
+Every rollup document covers one time bucket and holds, for each rolled up field,
+its min, max, sum and count (mean = sum / count), as well as the last raw
+document of the bucket:
+
+    {"date": <bucket start>, "count": 12, "last": {...},
+     "temperature": {"min": 4.2, "max": 5.1, "sum": 55.3, "count": 12}}
+"""
+from datetime import datetime, timedelta, timezone
+
+# ordered from finest to coarsest
+RESOLUTIONS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+
+def get_path(document: dict, path: str):
+    # Resolve a dotted path such as "emeter_data.A.power"
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def bucket_start(date: datetime, resolution: str) -> datetime:
+    # Buckets are aligned on UTC, like the naive UTC dates returned by pymongo
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    step = RESOLUTIONS[resolution]
+    return datetime.min + ((date - datetime.min) // step) * step
+
+
+def select_resolution(start_date: datetime, end_date: datetime, min_points: int):
+    """Coarsest resolution still giving min_points buckets, None if raw data is needed."""
+    for resolution, step in reversed(RESOLUTIONS.items()):
+        if (end_date - start_date) / step >= min_points:
+            return resolution
+    return None
+
+
+def rollup_update(document: dict, fields: dict[str, str]) -> dict:
+    """Update adding one raw document to its bucket, to be used with upsert=True."""
+    update = {
+        "$min": {},
+        "$max": {},
+        "$inc": {"count": 1},
+        "$set": {"last": document},
+    }
+    for field, path in fields.items():
+        value = get_path(document, path)
+        if not _is_number(value):
+            continue
+        update["$min"][f"{field}.min"] = value
+        update["$max"][f"{field}.max"] = value
+        update["$inc"][f"{field}.sum"] = value
+        update["$inc"][f"{field}.count"] = 1
+
+    # mongo refuses empty update operators
+    return {operator: values for operator, values in update.items() if values}
+
+
+def rollup_pipeline(fields: dict[str, str], resolution: str, into: str) -> list:
+    """Aggregation rebuilding the rollups of a raw collection (requires MongoDB >= 5)."""
+    group = {
+        "_id": {"$dateTrunc": {"date": "$date", "unit": resolution}},
+        "count": {"$sum": 1},
+        "last": {"$last": "$$ROOT"},
+    }
+    rollup = {}
+    for field, path in fields.items():
+        group[f"{field}_min"] = {"$min": f"${path}"}
+        group[f"{field}_max"] = {"$max": f"${path}"}
+        group[f"{field}_sum"] = {"$sum": f"${path}"}
+        group[f"{field}_count"] = {
+            "$sum": {"$cond": [{"$isNumber": f"${path}"}, 1, 0]}
+        }
+        rollup[field] = {
+            stat: f"${field}_{stat}" for stat in ["min", "max", "sum", "count"]
+        }
+
+    return [
+        {"$sort": {"date": 1}},
+        {"$group": group},
+        {
+            "$project": {
+                "_id": 0,
+                "date": "$_id",
+                "count": 1,
+                "last": 1,
+                **rollup,
+            }
+        },
+        {
+            "$merge": {
+                "into": into,
+                "on": "date",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
@@ -0,0 +1,119 @@
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from threading import Event, Thread
+from typing import Callable
+
+
+@dataclass
+class PollStats:
+    # Latency and failures of the runs of a job, or of the polls of one device
+    runs: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_latency: float = None
+    total_latency: float = 0.0
+    last_error: str = None
+    last_success: datetime = None
+
+    def record(self, latency: float, error: Exception = None) -> None:
+        if error is not None:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+        else:
+            self.consecutive_failures = 0
+            self.last_success = datetime.now(timezone.utc)
+        self.runs += 1
+        self.last_latency = latency
+        self.total_latency += latency
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_latency": self.last_latency,
+            "mean_latency": self.total_latency / self.runs if self.runs else None,
+            "last_error": self.last_error,
+            "last_success": self.last_success.isoformat() if self.last_success else None,
+        }
+
+
+@dataclass
+class PollJob(PollStats):
+    name: str = None
+    interval: float = None
+    poll: Callable[[], None] = None
+    # stats of every device polled by the job, recorded by its poll function
+    devices: dict[str, PollStats] = field(default_factory=dict)
+
+    def device(self, name: str) -> PollStats:
+        return self.devices.setdefault(name, PollStats())
+
+    def run(self) -> None:
+        started = time.perf_counter()
+        error = None
+        try:
+            self.poll()
+        except Exception as e:
+            error = e
+            print(f"Polling {self.name} failed: {type(e).__name__}: {e}")
+        finally:
+            self.record(time.perf_counter() - started, error)
+
+    def stats(self) -> dict:
+        stats = {"interval": self.interval, **super().stats()}
+        if self.devices:
+            stats["devices"] = {
+                name: device.stats() for name, device in list(self.devices.items())
+            }
+        return stats
+
+
+class PollScheduler:
+    """Run every job in the background on its own interval.
+
+    Each job gets its own daemon thread, so a slow vendor API only delays
+    its own polls.
+    """
+
+    def __init__(self, on_run: Callable[[PollJob], None] = None):
+        # on_run is called after every run of a job, e.g. to report its timing
+        self.on_run = on_run
+        self.jobs: list[PollJob] = []
+        self._stop = Event()
+        self._threads: list[Thread] = []
+
+    def add_job(self, name: str, interval: float, poll: Callable[[], None]) -> PollJob:
+        job = PollJob(name=name, interval=interval, poll=poll)
+        self.jobs.append(job)
+        return job
+
+    def start(self, jobs: list[PollJob] = None) -> None:
+        # All jobs by default
+        for job in self.jobs if jobs is None else jobs:
+            thread = Thread(
+                target=self._run_job, args=(job,), name=f"poll-{job.name}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def job(self, name: str) -> PollJob:
+        return next(job for job in self.jobs if job.name == name)
+
+    def stats(self) -> dict:
+        return {job.name: job.stats() for job in self.jobs}
+
+    def _run_job(self, job: PollJob) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            job.run()
+            if self.on_run is not None:
+                self.on_run(job)
+            self._stop.wait(max(0.0, job.interval - (time.monotonic() - started)))
@@ -0,0 +1,97 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.metrics import EXTERNAL_CALL_SECONDS
+
+
+class RateLimiter:
+    """Space calls at least 1 / rate seconds apart, across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_call = 0.0
+        self._lock = Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            call = max(now, self._next_call)
+            self._next_call = call + self.interval
+        if call > now:
+            time.sleep(call - now)
+
+
+class ShellyClient:
+    """Process wide Shelly cloud client.
+
+    Requests go through one session, its keep-alive connections are reused
+    across polls. The devices of a poll are fetched concurrently by max_workers
+    threads, started no faster than requests_per_second, the rate limit of the
+    cloud API. A poll then waits for the network latency about once, not once
+    per device.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        auth_key: str,
+        max_workers: int = 4,
+        requests_per_second: float = 1.0,
+        timeout: float = 10.0,
+    ):
+        self.api_url = api_url
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="shelly")
+        # seconds taken by the last status request of every device
+        self.latencies = {}
+
+    def device_status(self, device_id: str) -> dict:
+        self.rate_limiter.wait()
+        started = time.perf_counter()
+        try:
+            with EXTERNAL_CALL_SECONDS.time(
+                service="shelly", operation="device/status"
+            ):
+                response = self.session.post(
+                    self.api_url,
+                    data={"id": device_id, "auth_key": self.auth_key},
+                    timeout=self.timeout,
+                )
+        finally:
+            self.latencies[device_id] = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Shelly status of {device_id} failed: HTTP {response.status_code}"
+            )
+        data = response.json()
+        if not data.get("isok"):
+            raise RuntimeError(f"Invalid Shelly status of {device_id}: {data}")
+        return data["data"]["device_status"]
+
+    def device_statuses(self, device_ids: list[str]) -> dict[str, dict]:
+        """Status of every device, the exception instead for a failed device."""
+        futures = {
+            device_id: self.executor.submit(self.device_status, device_id)
+            for device_id in device_ids
+        }
+        statuses = {}
+        for device_id, future in futures.items():
+            try:
+                statuses[device_id] = future.result()
+            except Exception as e:
+                statuses[device_id] = e
+        return statuses
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import Iterator
+
+from utils.queries import SeriesRange
+
+
+class Storage:
+    """Where the readings of the sensors are kept.
+
+    The storage only relies on the sensor's collection_name, the columns it
+    stores (rollup_fields, column -> path of the value in a reading) and the
+    fields of its latest reading (status_fields).
+    """
+
+    def append(self, sensor, document: dict, callback=None) -> None:
+        """Store a reading, callback is called once it is readable."""
+        raise NotImplementedError
+
+    def query_range(
+        self, sensor, start_date: datetime, end_date: datetime, columns: list[str]
+    ) -> SeriesRange:
+        """Readings of the given columns within the range, sorted by date."""
+        raise NotImplementedError
+
+    def query_since(
+        self, sensor, after: datetime, columns: list[str], limit: int
+    ) -> SeriesRange:
+        """At most limit raw readings newer than after, oldest first."""
+        raise NotImplementedError
+
+    def export(
+        self,
+        sensor,
+        start_date: datetime,
+        end_date: datetime,
+        fields: dict[str, str],
+        batch_size: int,
+    ) -> Iterator[SeriesRange]:
+        """Raw readings within the range, sorted by date, batch_size at a time.
+
+        fields maps the exported columns to the path of their value in a
+        reading. The columns are floats, fields holding text can not be
+        exported.
+        """
+        raise NotImplementedError
+
+    def latest(self, sensor) -> dict:
+        """Status fields and date of the latest reading, None without readings."""
+        raise NotImplementedError
+
+    def ensure_indexes(self, sensor) -> None:
+        pass
+
+    def compact(self, sensor, batch_size: int) -> Iterator[int]:
+        """Delete the readings past their retention, yields the count of every batch.
+
+        The caller may pause between batches or stop early, the next call
+        carries on. Nothing is deleted by default.
+        """
+        return iter(())
@@ -0,0 +1,66 @@
+"""
+MongoDB time-series collections for the raw sensor readings.
+
+The readings are stored in buckets by the server, with "date" as the timeField
+and the sensor id in the metaField:
+
+    {"date": <reading date>, "sensor": "KellerPlug", "current_temperature": 8.5, ...}
+"""
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+
+TIME_FIELD = "date"
+META_FIELD = "sensor"
+
+# error code of createCollection when the collection already exists
+NAMESPACE_EXISTS = 48
+
+
+def create_timeseries_collection(db, name: str, granularity: str = "minutes"):
+    """Time-series collection of the given name, created when it does not exist yet."""
+    if name not in db.list_collection_names(filter={"name": name}):
+        try:
+            db.create_collection(
+                name,
+                timeseries={
+                    "timeField": TIME_FIELD,
+                    "metaField": META_FIELD,
+                    "granularity": granularity,
+                },
+            )
+        except CollectionInvalid:
+            # created concurrently by another worker
+            pass
+        except OperationFailure as e:
+            if e.code != NAMESPACE_EXISTS:
+                raise
+    return db[name]
+
+
+def copy_to_timeseries(
+    source, target, sensor_id: str, batch_size: int = 10000
+) -> tuple[int, int]:
+    """Copy all documents of source into target in batches, oldest first.
+
+    Returns the number of copied and of rejected documents, e.g. readings
+    without a date.
+    """
+    copied = 0
+    rejected = 0
+    batch = []
+
+    def write(batch: list) -> None:
+        nonlocal copied, rejected
+        try:
+            copied += len(target.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            copied += e.details["nInserted"]
+            rejected += len(e.details["writeErrors"])
+
+    for document in source.find({}).sort(TIME_FIELD, 1).batch_size(batch_size):
+        batch.append({**document, META_FIELD: sensor_id})
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    return copied, rejected
@@ -0,0 +1,60 @@
+import time
+from threading import Lock
+
+from tuya_connector import TuyaOpenAPI
+
+from utils.metrics import EXTERNAL_CALL_SECONDS
+
+# maximum number of device ids per batch status request
+STATUS_BATCH_SIZE = 20
+
+
+class TuyaClient:
+    """Process wide Tuya cloud client.
+
+    The access token is reused across polls and renewed refresh_margin seconds
+    before it expires, instead of connecting again for every poll.
+    """
+
+    def __init__(
+        self, endpoint: str, access_id: str, access_key: str, refresh_margin: float = 300
+    ):
+        self.openapi = TuyaOpenAPI(endpoint, access_id, access_key)
+        self.refresh_margin = refresh_margin
+        self._lock = Lock()
+
+    def _token_expires_soon(self) -> bool:
+        token_info = self.openapi.token_info
+        if token_info is None or not token_info.access_token:
+            return True
+        return token_info.expire_time - self.refresh_margin * 1000 <= time.time() * 1000
+
+    def _connect(self) -> None:
+        # a new token must not be signed with the expiring one
+        self.openapi.token_info = None
+        with EXTERNAL_CALL_SECONDS.time(service="tuya", operation="connect"):
+            response = self.openapi.connect()
+        if not response or not response.get("success"):
+            raise RuntimeError(f"Failed to connect to the Tuya cloud: {response}")
+
+    def get(self, path: str, params: dict = None):
+        with self._lock:
+            if self._token_expires_soon():
+                self._connect()
+            with EXTERNAL_CALL_SECONDS.time(service="tuya", operation=path):
+                response = self.openapi.get(path, params)
+        if not response or not response.get("success"):
+            raise RuntimeError(f"Tuya request {path} failed: {response}")
+        return response["result"]
+
+    def device_statuses(self, device_ids: list[str]) -> dict[str, list[dict]]:
+        """Status data points of every device, fetched in batches."""
+        statuses = {}
+        for start in range(0, len(device_ids), STATUS_BATCH_SIZE):
+            batch = device_ids[start : start + STATUS_BATCH_SIZE]
+            result = self.get(
+                "/v1.0/iot-03/devices/status", {"device_ids": ",".join(batch)}
+            )
+            for device in result:
+                statuses[device["id"]] = device["status"]
+        return statuses
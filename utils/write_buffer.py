@@ -0,0 +1,170 @@
+import time
+from queue import Empty, Queue
+from threading import Event, Thread
+
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from utils.metrics import WRITE_ERRORS_TOTAL
+
+DUPLICATE_KEY = 11000
+
+# tells the writer thread to write what is left and stop
+_CLOSE = object()
+
+
+class WriteBuffer:
+    """Write-behind buffer in front of the mongo collections.
+
+    Operations are queued and written by a background thread with one
+    bulk_write per collection, once batch_size operations are pending or
+    flush_interval seconds after the first pending one. The queue is bounded:
+    when max_pending operations wait, add() blocks until the writer catches up.
+
+    A write that lost its connection is retried max_retries times, waiting
+    retry_delay seconds and twice as long after every attempt. Operations the
+    server rejects are not retried, they are counted as failed and their
+    callbacks are not called.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_pending: int = 10000,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = Queue(maxsize=max_pending)
+        self._closed = Event()
+        self._thread = Thread(target=self._run, name="write-buffer", daemon=True)
+        self._thread.start()
+
+    def add(self, collection, operation, callback=None) -> None:
+        """Queue a write, callback is called once the batch holding it is written."""
+        if self._closed.is_set():
+            raise RuntimeError("The write buffer is closed")
+        self._queue.put((collection, operation, callback))
+
+    def insert(self, collection, document: dict, callback=None) -> None:
+        self.add(collection, InsertOne(document), callback)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float = None) -> None:
+        # Write all pending operations and stop the writer thread
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        batch = []
+        flush_at = None
+        while True:
+            timeout = (
+                max(0.0, flush_at - time.monotonic()) if batch else self.flush_interval
+            )
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+
+            if item is _CLOSE:
+                self._write(batch)
+                return
+            if item is not None:
+                if not batch:
+                    flush_at = time.monotonic() + self.flush_interval
+                batch.append(item)
+            if batch and (
+                len(batch) >= self.batch_size or time.monotonic() >= flush_at
+            ):
+                self._write(batch)
+                batch = []
+
+    def _write(self, batch: list) -> None:
+        if not batch:
+            return
+
+        # keep the order of the operations within each collection
+        operations = {}
+        for item in batch:
+            operations.setdefault(item[0], []).append(item)
+
+        callbacks = []
+        for collection, items in operations.items():
+            rejected = self._bulk_write(
+                collection, [operation for _, operation, _ in items]
+            )
+            self.written += len(items) - len(rejected)
+            if rejected:
+                self.failed += len(rejected)
+                WRITE_ERRORS_TOTAL.inc(len(rejected), collection=collection.name)
+                print(
+                    f"Failed to write {len(rejected)} operations to {collection.name}"
+                )
+            callbacks.extend(
+                callback
+                for index, (_, _, callback) in enumerate(items)
+                if callback is not None and index not in rejected
+            )
+        self.batches += 1
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Write buffer callback failed: {e}")
+
+    def _bulk_write(self, collection, operations: list) -> set[int]:
+        # Indexes of the operations that could not be written
+        # inserts do not depend on each other, updates of a bucket do
+        ordered = not all(isinstance(operation, InsertOne) for operation in operations)
+        pending = list(range(len(operations)))
+        rejected = set()
+        attempt = 0
+        while pending:
+            try:
+                collection.bulk_write(
+                    [operations[index] for index in pending], ordered=ordered
+                )
+                return rejected
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                for error in errors:
+                    index = pending[error["index"]]
+                    # the insert was written by the attempt that lost its connection
+                    if (
+                        attempt
+                        and error["code"] == DUPLICATE_KEY
+                        and isinstance(operations[index], InsertOne)
+                    ):
+                        continue
+                    print(f"{collection.name} rejected a write: {error['errmsg']}")
+                    rejected.add(index)
+                if not (ordered and errors):
+                    return rejected
+                # an ordered write stops at its first error, the rest is sent again
+                pending = pending[errors[0]["index"] + 1 :]
+            except ConnectionFailure as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    print(f"Failed to write to {collection.name}: {e}")
+                    break
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            except Exception as e:
+                # the writer thread must survive a failed batch
+                print(f"Failed to write to {collection.name}: {e}")
+                break
+        rejected.update(pending)
+        return rejected